@@ -1,131 +1,242 @@
 from re import compile
 from math import pi, log, tan, ceil
+from hashlib import md5
+from collections import OrderedDict
 
 import json
 
+try:
+    import numpy
+except ImportError:
+    # numpy is optional, mercator_coords() projects plain lists without it.
+    numpy = None
+
 from shapely.wkb import loads
-from shapely.geometry import asShape
+try:
+    from shapely.geometry import asShape
+except ImportError:
+    # Shapely 2 dropped the adapter classes, shape() makes a copy instead.
+    from shapely.geometry import shape as asShape
 
-from ... import getTile
 from ...Core import KnownUnknown
-from .ops import transform
+from .ops import transform_coords
+from .wkb import geo_interface
+from .sublayers import load_tiles
 
 float_pat = compile(r'^-?\d+\.\d+(e-?\d+)?$')
 charfloat_pat = compile(r'^[\[,\,]-?\d+\.\d+(e-?\d+)?$')
 
+# start of a GeoJSON body from encode(), matched to check it without parsing.
+feature_collection_pat = compile(br'^\s*\{\s*"type"\s*:\s*"FeatureCollection"\s*,')
+
+# first characters of tokens that float_pat or charfloat_pat could possibly match.
+float_heads = frozenset('-0123456789')
+charfloat_heads = frozenset('[,')
+
+# compact encoder shared by every encode() call.
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+# approximate number of characters _write_tokens() gathers before each write.
+write_chunk_size = 65536
+
 # floating point lat/lon precision for each zoom level, good to ~1/4 pixel.
 precisions = [int(ceil(log(1<<zoom + 8+2) / log(10)) - 2) for zoom in range(23)]
 
-def get_tiles(names, config, coord):
+# constant factors of the spherical mercator formula used by mercator() and mercator_coords().
+_mercator_x, _mercator_y, _quarter_pi = 6378137 * pi / 180, pi / 360, 0.25 * pi
+
+# recently decoded tiles, keyed on a digest of their raw GeoJSON body,
+# in order from least to most recently used.
+_decoded_features = OrderedDict()
+_decoded_features_max = 64
+
+def get_tiles(names, config, coord, jobs=None):
     ''' Retrieve a list of named GeoJSON layer tiles from a TileStache config.
     
         Check integrity and compatibility of each, looking at known layers,
         correct JSON mime-types and "FeatureCollection" in the type attributes.
     '''
+    bodies = _get_tiles(names, config, coord, jobs)
+    
+    return [json.loads(body.decode('utf8')) for body in bodies]
+
+def _get_tiles(names, config, coord, jobs=None):
+    ''' Retrieve named GeoJSON layer tiles, return their raw bodies.
+    
+        Performs the integrity checks documented in get_tiles(). Bodies
+        from encode() start with their "FeatureCollection" type, so most
+        are checked without being parsed.
+    '''
     unknown_layers = set(names) - set(config.layers.keys())
     
     if unknown_layers:
         raise KnownUnknown("%s.get_tiles didn't recognize %s when trying to load %s." % (__name__, ', '.join(unknown_layers), ', '.join(names)))
     
     layers = [config.layers[name] for name in names]
-    mimes, bodies = zip(*[getTile(layer, coord, 'json') for layer in layers])
+    mimes, bodies = zip(*load_tiles(layers, coord, 'json', jobs))
     bad_mimes = [(name, mime) for (mime, name) in zip(mimes, names) if not mime.endswith('/json')]
     
     if bad_mimes:
         raise KnownUnknown('%s.get_tiles encountered a non-JSON mime-type in %s sub-layer: "%s"' % ((__name__, ) + bad_mimes[0]))
     
-    geojsons = [json.loads(body.decode('utf8')) for body in bodies]
-    bad_types = [(name, topo['type']) for (topo, name) in zip(geojsons, names) if topo['type'] != 'FeatureCollection']
+    types = [_geojson_type(body) for body in bodies]
+    bad_types = [(name, type) for (type, name) in zip(types, names) if type != 'FeatureCollection']
     
     if bad_types:
         raise KnownUnknown('%s.get_tiles encountered a non-FeatureCollection type in %s sub-layer: "%s"' % ((__name__, ) + bad_types[0]))
     
-    return geojsons
+    return bodies
+
+def _geojson_type(body):
+    ''' Get the type of a GeoJSON body, parsing it only if it's not at the start.
+    '''
+    if feature_collection_pat.match(body):
+        return 'FeatureCollection'
+    
+    return json.loads(body.decode('utf8'))['type']
+
+def _write_tokens(file, tokens, flt_fmt):
+    ''' Write JSONEncoder.iterencode() tokens to a file with truncated floats.
+    
+        Most tokens are punctuation, keys or strings, so a cheap check of
+        the first character rules them out before any regular expression.
+        
+        Tokens are gathered into chunks of about 64KB, and each chunk is
+        encoded and written in one call instead of one write per token.
+    '''
+    format_float = flt_fmt.__mod__
+    pieces, length = [], 0
+    
+    for token in tokens:
+        head = token[:1]
+        
+        if head in charfloat_heads and charfloat_pat.match(token):
+            # in python 2.7, we see a character followed by a float literal
+            piece = head + format_float(float(token[1:]))
+        elif head in float_heads and float_pat.match(token):
+            # in python 2.6, we see a simple float literal
+            piece = format_float(float(token))
+        else:
+            piece = token
+        
+        pieces.append(piece)
+        length += len(piece)
+        
+        if length >= write_chunk_size:
+            file.write(''.join(pieces).encode('utf8'))
+            pieces, length = [], 0
+    
+    file.write(''.join(pieces).encode('utf8'))
 
 def mercator(xy):
     ''' Project an (x, y) tuple to spherical mercator.
     '''
     _x, _y = xy
-    x, y = pi * _x/180, pi * _y/180
-    y = log(tan(0.25 * pi + 0.5 * y))
-    return 6378137 * x, 6378137 * y
+    return _mercator_x * _x, 6378137 * log(tan(_quarter_pi + _mercator_y * _y))
+
+def mercator_coords(xs, ys):
+    ''' Project sequences of x and y values to spherical mercator.
+    '''
+    if numpy is None:
+        return [_mercator_x * _x for _x in xs], \
+               [6378137 * log(tan(_quarter_pi + _mercator_y * _y)) for _y in ys]
+    
+    return _mercator_x * xs, 6378137 * numpy.log(numpy.tan(_quarter_pi + _mercator_y * ys))
 
 def decode(file):
     ''' Decode a GeoJSON file into a list of (WKB, property dict) features.
     
         Result can be passed directly to mapnik.PythonDatasource.wkb_features().
+        
+        Features of the most recently used tiles are kept in memory, so a
+        tile whose body is requested again is not parsed and projected twice.
+        Each call returns new property dictionaries, but values inside them
+        such as lists are shared with the cache and should not be changed.
     '''
-    data = json.load(file)
-    features = []
+    body = file.read()
+    key = md5(body).digest()
+    features = _decoded_features.pop(key, None)
     
-    for feature in data['features']:
-        if feature['type'] != 'Feature':
-            continue
+    if features is None:
+        data = json.loads(body.decode('utf8'))
+        features = []
         
-        if feature['geometry']['type'] == 'GeometryCollection':
-            continue
-        
-        prop = feature['properties']
-        geom = transform(asShape(feature['geometry']), mercator)
-        features.append((geom.wkb, prop))
+        for feature in data['features']:
+            if feature['type'] != 'Feature':
+                continue
+            
+            if feature['geometry']['type'] == 'GeometryCollection':
+                continue
+            
+            prop = feature['properties']
+            geom = transform_coords(asShape(feature['geometry']), mercator_coords)
+            features.append((geom.wkb, prop))
+    
+    # most recently used tiles go last, and the least recently used are dropped.
+    _decoded_features[key] = features
+    
+    while len(_decoded_features) > _decoded_features_max:
+        _decoded_features.popitem(last=False)
+    
+    return [(wkb, prop if prop is None else dict(prop)) for (wkb, prop) in features]
+
+def _geometry(geom):
+    ''' Return a GeoJSON geometry dictionary for WKB or a shapely geometry.
     
-    return features
+        Plain 2D WKB is read directly, skipping a round-trip through shapely.
+    '''
+    if hasattr(geom, '__geo_interface__'):
+        return geom.__geo_interface__
+    
+    try:
+        return geo_interface(geom)
+    except ValueError:
+        return loads(bytes(geom)).__geo_interface__
 
 def encode(file, features, zoom, is_clipped):
     ''' Encode a list of (WKB, property dict) features into a GeoJSON stream.
     
-        Also accept three-element tuples as features: (WKB, property dict, id).
+        Also accept three-element tuples as features: (WKB, property dict, id),
+        and shapely geometries or any bytes-like object in place of WKB.
     
         Geometries in the features list are assumed to be unprojected lon, lats.
         Floating point precision in the output is truncated to six digits.
     '''
-    try:
-        # Assume three-element features
-        features = [dict(type='Feature', properties=p, geometry=loads(g).__geo_interface__, id=i) for (g, p, i) in features]
+    if features and len(features[0]) == 3:
+        features = [dict(type='Feature', properties=p, geometry=_geometry(g), id=i) for (g, p, i) in features]
 
-    except ValueError:
-        # Fall back to two-element features
-        features = [dict(type='Feature', properties=p, geometry=loads(g).__geo_interface__) for (g, p) in features]
+    else:
+        features = [dict(type='Feature', properties=p, geometry=_geometry(g)) for (g, p) in features]
     
     if is_clipped:
         for feature in features:
             feature.update(dict(clipped=True))
     
     geojson = dict(type='FeatureCollection', features=features)
-    encoder = json.JSONEncoder(separators=(',', ':'))
-    encoded = encoder.iterencode(geojson)
+    
+    encoded = _encoder.iterencode(geojson)
     flt_fmt = '%%.%df' % precisions[zoom]
     
-    for token in encoded:
-        if charfloat_pat.match(token):
-            # in python 2.7, we see a character followed by a float literal
-            piece = token[0] + flt_fmt % float(token[1:])
-        elif float_pat.match(token):
-            # in python 2.6, we see a simple float literal
-            piece = flt_fmt % float(token)
-        else:
-            piece = token
-        file.write(piece.encode('utf8'))
+    _write_tokens(file, encoded, flt_fmt)
 
-def merge(file, names, config, coord):
+def merge(file, names, config, coord, jobs=None):
     ''' Retrieve a list of GeoJSON tile responses and merge them into one.
     
         get_tiles() retrieves data and performs basic integrity checks.
+        
+        Sub-layer bodies are already encoded GeoJSON at this tile's precision,
+        so they are written out verbatim under their layer names rather than
+        being parsed and encoded a second time.
     '''
-    inputs = get_tiles(names, config, coord)
-    output = dict(zip(names, inputs))
-
-    encoder = json.JSONEncoder(separators=(',', ':'))
-    encoded = encoder.iterencode(output)
-    flt_fmt = '%%.%df' % precisions[coord.zoom]
+    bodies = _get_tiles(names, config, coord, jobs)
     
-    for token in encoded:
-        if charfloat_pat.match(token):
-            # in python 2.7, we see a character followed by a float literal
-            piece = token[0] + flt_fmt % float(token[1:])
-        elif float_pat.match(token):
-            # in python 2.6, we see a simple float literal
-            piece = flt_fmt % float(token)
-        else:
-            piece = token
-        file.write(piece.encode('utf8'))
+    file.write(b'{')
+    
+    for (index, (name, body)) in enumerate(zip(names, bodies)):
+        if index > 0:
+            file.write(b',')
+        
+        file.write(json.dumps(name).encode('utf8') + b':')
+        file.write(body)
+    
+    file.write(b'}')
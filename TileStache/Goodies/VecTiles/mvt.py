@@ -36,13 +36,18 @@ By default, encode() approximates the floating point precision of WKB geometry
 to 26 bits for a significant compression improvement and no visible impact on
 rendering at zoom 18 and lower.
 '''
-from io import BytesIO
-from zlib import decompress as _decompress, compress as _compress
-from struct import unpack as _unpack, pack as _pack
+from zlib import decompress as _decompress, compressobj as _compressobj
+from struct import Struct as _Struct
 import json
 
 from .wkb import approximate_wkb
 
+_uint32 = _Struct('>I')
+_pack_uint32, _unpack_uint32 = _uint32.pack, _uint32.unpack_from
+
+# approximate number of uncompressed bytes encode() gathers per compress() call.
+compress_chunk_size = 65536
+
 def decode(file):
     ''' Decode an MVT file into a list of (WKB, property dict) features.
     
@@ -50,17 +55,29 @@ def decode(file):
     '''
     head = file.read(4)
     
-    if head != '\x89MVT':
+    if head != b'\x89MVT':
         raise Exception('Bad head: "%s"' % head)
     
-    body = BytesIO(_decompress(file.read(_next_int(file))))
+    (length, ) = _unpack_uint32(file.read(4))
+    body = _decompress(file.read(length))
+    
+    #
+    # Walk the decompressed body with an offset instead of
+    # wrapping it in a file and reading it four bytes at a time.
+    #
+    (count, ), offset = _unpack_uint32(body), 4
     features = []
     
-    for i in range(_next_int(body)):
-        wkb = body.read(_next_int(body))
-        raw = body.read(_next_int(body))
+    for i in range(count):
+        (length, ) = _unpack_uint32(body, offset)
+        wkb = body[offset + 4:offset + 4 + length]
+        offset += 4 + length
+        
+        (length, ) = _unpack_uint32(body, offset)
+        raw = body[offset + 4:offset + 4 + length]
+        offset += 4 + length
 
-        props = json.loads(raw)
+        props = json.loads(raw.decode('utf8'))
         features.append((wkb, props))
     
     return features
@@ -68,24 +85,36 @@ def decode(file):
 def encode(file, features):
     ''' Encode a list of (WKB, property dict) features into an MVT stream.
     
-        Geometries in the features list are assumed to be in spherical mercator.
+        Geometries in the features list are assumed to be in spherical mercator,
+        as WKB in any bytes-like object such as a memoryview.
         Floating point precision in the output is approximated to 26 bits.
     '''
-    parts = []
+    compressor = _compressobj()
+    compress, pack_uint32 = compressor.compress, _pack_uint32
+    
+    #
+    # Compress features as they are encoded, so the uncompressed
+    # body never has to exist in memory all at once. Feature bytes
+    # go into one reused buffer that is compressed a chunk at a time.
+    #
+    body, raw = bytearray(), bytearray(pack_uint32(len(features)))
     
     for feature in features:
         wkb = approximate_wkb(feature[0])
-        prop = json.dumps(feature[1])
+        prop = json.dumps(feature[1]).encode('utf8')
+        
+        raw += pack_uint32(len(wkb))
+        raw += wkb
+        raw += pack_uint32(len(prop))
+        raw += prop
         
-        parts.extend([_pack('>I', len(wkb)), wkb, _pack('>I', len(prop)), prop])
+        if len(raw) >= compress_chunk_size:
+            body += compress(raw)
+            del raw[:]
     
-    body = _compress(_pack('>I', len(features)) + b''.join(parts))
+    body += compress(raw)
+    body += compressor.flush()
     
     file.write(b'\x89MVT')
-    file.write(_pack('>I', len(body)))
+    file.write(pack_uint32(len(body)))
     file.write(body)
-
-def _next_int(file):
-    ''' Read the next big-endian 4-byte unsigned int from a file.
-    '''
-    return _unpack('!I', file.read(4))[0]
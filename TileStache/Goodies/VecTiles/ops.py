@@ -48,27 +48,126 @@ POLYGON ((1.00... 1.00..., 4.00... 1.00..., 4.00... 4.00..., 1.00... 4.00..., 1.
 MULTIPOLYGON (((1.00... 1.00..., 4.00... 1.00..., 4.00... 4.00..., 1.00... 4.00..., 1.00... 1.00...), (2.00... 2.00..., 3.00... 2.00..., 3.00... 3.00..., 2.00... 3.00..., 2.00... 2.00...)), ((11.00... 11.00..., 14.00... 11.00..., 14.00... 14.00..., 11.00... 14.00..., 11.00... 11.00...), (12.00... 12.00..., 13.00... 12.00..., 13.00... 13.00..., 12.00... 13.00..., 12.00... 12.00...)))
 '''
 
+try:
+    import numpy
+except ImportError:
+    # numpy is optional, transform_coords() passes plain lists without it.
+    numpy = None
+
 def transform(shape, func):
     ''' Apply a function to every coordinate in a geometry.
     '''
-    construct = shape.__class__
+    construct, geom_type = shape.__class__, shape.geom_type
     
-    if shape.type.startswith('Multi'):
+    if geom_type.startswith('Multi'):
         parts = [transform(geom, func) for geom in shape.geoms]
         return construct(parts)
     
-    if shape.type in ('Point', 'LineString'):
-        return construct(map(func, shape.coords))
+    if geom_type in ('Point', 'LineString'):
+        return construct([func(coord) for coord in shape.coords])
         
-    if shape.type == 'Polygon':
-        exterior = map(func, shape.exterior.coords)
-        rings = [map(func, ring.coords) for ring in shape.interiors]
+    if geom_type == 'Polygon':
+        exterior = [func(coord) for coord in shape.exterior.coords]
+        rings = [[func(coord) for coord in ring.coords] for ring in shape.interiors]
         return construct(exterior, rings)
     
-    if shape.type == 'GeometryCollection':
+    if geom_type == 'GeometryCollection':
         return construct()
     
-    raise ValueError('Unknown geometry type, "%s"' % shape.type)
+    raise ValueError('Unknown geometry type, "%s"' % geom_type)
+
+def flatten(shape):
+    ''' Return all coordinates of a geometry in one list, and a ring tree.
+    
+        The ring tree mirrors the nesting of the geometry, and holds
+        everything unflatten() needs to build it again from the list.
+    '''
+    construct, geom_type = shape.__class__, shape.geom_type
+    
+    if geom_type.startswith('Multi'):
+        coords, parts = [], []
+        
+        for geom in shape.geoms:
+            part_coords, part_tree = flatten(geom)
+            coords.extend(part_coords)
+            parts.append(part_tree)
+        
+        return coords, (construct, geom_type, parts)
+    
+    if geom_type in ('Point', 'LineString'):
+        coords = list(shape.coords)
+        return coords, (construct, geom_type, len(coords))
+    
+    if geom_type == 'Polygon':
+        coords, lengths = list(shape.exterior.coords), []
+        lengths.append(len(coords))
+        
+        for ring in shape.interiors:
+            ring_coords = list(ring.coords)
+            coords.extend(ring_coords)
+            lengths.append(len(ring_coords))
+        
+        return coords, (construct, geom_type, lengths)
+    
+    if geom_type == 'GeometryCollection':
+        return [], (construct, geom_type, None)
+    
+    raise ValueError('Unknown geometry type, "%s"' % geom_type)
+
+def unflatten(coords, tree):
+    ''' Build a geometry from a list of coordinates and a ring tree from flatten().
+    '''
+    shape, offset = _unflatten(coords, tree, 0)
+    return shape
+
+def _unflatten(coords, tree, offset):
+    ''' Build a geometry from coordinates at an offset, return it and the next offset.
+    '''
+    construct, geom_type, size = tree
+    
+    if geom_type.startswith('Multi'):
+        parts = []
+        
+        for part_tree in size:
+            part, offset = _unflatten(coords, part_tree, offset)
+            parts.append(part)
+        
+        return construct(parts), offset
+    
+    if geom_type in ('Point', 'LineString'):
+        return construct(coords[offset:offset + size]), offset + size
+    
+    if geom_type == 'Polygon':
+        rings = []
+        
+        for length in size:
+            rings.append(coords[offset:offset + length])
+            offset += length
+        
+        return construct(rings[0], rings[1:]), offset
+    
+    return construct(), offset
+
+def transform_coords(shape, func):
+    ''' Apply a function to all coordinates in a geometry at once.
+    
+        Function is called once with a sequence of x values and a sequence
+        of y values, numpy arrays if numpy is available, and should return
+        transformed sequences of x and y values. Z values are dropped.
+    '''
+    coords, tree = flatten(shape)
+    
+    if numpy is None:
+        xs, ys = func([coord[0] for coord in coords], [coord[1] for coord in coords])
+        return unflatten(list(zip(xs, ys)), tree)
+    
+    if shape.has_z:
+        # parts of a multi-geometry may have Z values or not, keep x and y only.
+        coords = [coord[:2] for coord in coords]
+    
+    xys = numpy.array(coords, dtype=float).reshape(-1, 2)
+    xs, ys = func(xys[:,0], xys[:,1])
+    return unflatten(list(zip(numpy.asarray(xs).tolist(), numpy.asarray(ys).tolist())), tree)
 
 if __name__ == '__main__':
     from doctest import testmod
@@ -43,7 +43,7 @@ def get_feature_layer(name, features):
     for feature in features:
         wkb, props, fid = feature
         _features.append({
-            'geometry': wkb,
+            'geometry': bytes(wkb),
             'properties': props,
             'id': fid,
         })
@@ -7,7 +7,11 @@ for use in Mapnik with the VecTiles Datasource, which can read binary MVT tiles.
 For a more general implementation, try the Vector provider:
     http://tilestache.org/doc/#vector-provider
 '''
-from math import pi
+from math import pi, ceil, log10
+from binascii import a2b_base64
+from hashlib import md5
+from weakref import WeakKeyDictionary
+from collections import OrderedDict
 try:
     from urllib.parse import urljoin, urlparse
 except ImportError:
@@ -18,12 +22,25 @@ try:
 except ImportError:
     # Python 2
     from urllib import urlopen
+try:
+    from queue import Queue, Empty
+except ImportError:
+    # Python 2
+    from Queue import Queue, Empty
+try:
+    from sys import intern
+except ImportError:
+    # Python 2
+    pass
+from os import getpid
+from time import sleep
 from os.path import exists
+from threading import Thread, Event, Lock, BoundedSemaphore
 
 try:
-    from psycopg2.extras import RealDictCursor
     from psycopg2 import connect
-    from psycopg2.extensions import TransactionRollbackError
+    from psycopg2.pool import ThreadedConnectionPool
+    from psycopg2.extensions import TransactionRollbackError, string_types as typecasters
 
 except ImportError as err:
     # Still possible to build the documentation without psycopg2
@@ -31,11 +48,58 @@ except ImportError as err:
     def connect(*args, **kwargs):
         raise err
 
-from . import mvt, geojson, topojson, pbf
+    ThreadedConnectionPool = connect
+    typecasters = {}
+
+from . import mvt, geojson, topojson, pbf, twkb
+from .wkb import is_empty
 from ...Geography import SphericalMercator
 from ModestMaps.Core import Point
 
-tolerances = [6378137 * 2 * pi / (2 ** (zoom + 8)) for zoom in range(20)]
+try:
+    string_types = (str, unicode)
+except NameError:
+    # Python 3
+    string_types = (str, )
+
+tolerances = tuple([6378137 * 2 * pi / (2 ** (zoom + 8)) for zoom in range(20)])
+
+# shared connection pools keyed on process ID and frozen dbinfo items,
+# and their sizes keyed on frozen dbinfo items alone.
+_pools, _pool_sizes, _pools_lock = {}, {}, Lock()
+
+# rows fetched per round-trip from server-side cursors while reading features.
+cursor_itersize = 2000
+
+# seconds to wait before each retry of a query that hit a serialization
+# conflict in read_retrying(), doubling so retries don't all collide again.
+retry_delays = .01, .02, .04, .08
+
+# mime-types and formats for each file extension, see getTypeByExtension().
+extension_types = dict(mvt=('application/octet-stream+mvt', 'MVT'), json=('application/json', 'JSON'),
+                       topojson=('application/json', 'TopoJSON'), pbf=('application/x-protobuf', 'PBF'))
+
+multi_extension_types = dict([(ext, type) for (ext, type) in extension_types.items() if ext != 'mvt'])
+
+# build_query() is_geo, scale and hash_ids arguments for each response format.
+query_formats = dict(TopoJSON=(True, None, True), JSON=(True, None, True),
+                     MVT=(False, None, False), PBF=(False, pbf.extents, True))
+
+# shared projection for lonlat_bounds(), which has no per-tile state.
+_mercator = SphericalMercator()
+
+# build_query_template() and build_mvt_query_template() results, keyed on
+# all of their arguments, in order from least to most recently used.
+_query_templates, _query_templates_lock = OrderedDict(), Lock()
+_query_templates_max = 256
+
+# SQL expressions for generated feature IDs, keyed on id_hash option value.
+id_hashes = dict(md5='Substr(MD5(ST_AsBinary(q.__geometry__)), 1, 10)',
+                 hashtext='to_hex(hashtext(q.__geometry__::text))',
+                 hashint='hashtext(q.__geometry__::text)::bigint & 4294967295')
+
+# names of statements prepared by execute_prepared(), keyed on connection.
+_prepared, _prepared_lock = WeakKeyDictionary(), Lock()
 
 class Provider:
     ''' VecTiles provider for PostGIS data sources.
@@ -64,6 +128,11 @@ class Provider:
             
             This behavior is modeled on Mapnik's similar bbox token feature:
             https://github.com/mapnik/mapnik/wiki/PostGIS#bbox-token
+            
+            Every query is also filtered by "__geometry__ && <bbox>" outside
+            the query. Postgres pushes that filter into simple queries, but
+            not past GROUP BY, DISTINCT, LIMIT or window functions. Queries
+            with those should use "!bbox!" to filter rows by index early.
           
           clip:
             Optional boolean flag determines whether geometries are clipped to
@@ -82,11 +151,69 @@ class Provider:
             Optional floating point number of pixels to simplify all geometries.
             Useful for creating double resolution (retina) tiles set to 0.5, or
             set to 0.0 to prevent any simplification. Default 1.0.
+            
+            Simplifying once ahead of time is cheaper than on every tile: to
+            use geometry columns pre-simplified for each zoom, e.g. with
+            ST_SimplifyPreserveTopology in a materialized view, select them
+            as "__geometry__" in per-zoom queries and set simplify to 0.0.
         
           simplify_until:
             Optional integer specifying a zoom level where no more geometry
             simplification should occur. Default 16.
         
+          simplify_algorithm:
+            Optional name of the PostGIS simplification to use, "dp_topo" for
+            topology-preserving Douglas-Peucker (ST_SimplifyPreserveTopology),
+            "dp" for plain Douglas-Peucker (ST_Simplify), which is cheaper and
+            fine for point and line layers, or "vw" for Visvalingam-Whyatt
+            (ST_SimplifyVW, PostGIS 2.2+) with an area threshold of the
+            tolerance squared. Default "dp_topo".
+        
+          prepare_queries:
+            Optional boolean flag determines whether tile queries are run as
+            prepared statements with the tile bounds as parameters, so each
+            pooled connection plans a query once instead of once per tile.
+            Prepared results are not streamed from a server-side cursor.
+            Default false.
+        
+          twkb:
+            Optional boolean flag determines whether PostGIS sends geometries
+            as compact TWKB (ST_AsTWKB, PostGIS 2.2+) rounded to about a
+            quarter pixel, instead of full precision WKB. Default false.
+        
+          maxconn:
+            Optional maximum number of open Postgres connections in the pool
+            shared by all layers with the same dbinfo. Connections are opened
+            as concurrent tiles need them, and stay open in the pool for
+            later tiles once returned. Default 16.
+        
+          strict_intersects:
+            Optional boolean flag determines whether clipped features are
+            tested with ST_Intersects against the tile bounds, as well as the
+            bounding box index test. Default false: rely on the bounding box
+            test, and on clipping to drop features that don't reach into the
+            tile. Unclipped features are always tested with ST_Intersects.
+        
+          id_hash:
+            Optional name of the hash used for feature IDs when a query has
+            no "__id__" column, "md5" for the first ten hex digits of an MD5
+            of the geometry, "hashtext" for Postgres' faster non-crypto
+            32-bit hash in hex, or "hashint" for the same hash as a positive
+            integer, which PBF can store as a feature ID. IDs change when
+            this changes. Default "md5".
+        
+          validate_geometry:
+            Optional boolean flag determines whether every geometry is
+            repaired with ST_MakeValid, whether it is clipped or not. Set to
+            false for data known to be valid, such as osm2pgsql imports, to
+            skip the validity check on every row; invalid input may then fail
+            a clipped tile, or be sent out as stored. Default true.
+        
+          st_asmvt:
+            Optional boolean flag determines whether PBF tiles are encoded by
+            PostGIS with ST_AsMVT (PostGIS 2.4+), instead of in Python. Tiles
+            have no generated feature IDs in this mode. Default false.
+        
         Sample configuration, for a layer with no results at zooms 0-9, basic
         selection of lines with names and highway tags for zoom 10, a remote
         URL containing a query for zoom 11, and a local file for zooms 12+:
@@ -128,19 +255,38 @@ class Provider:
         Note that JSON requires keys to be strings, therefore the zoom levels
         must be enclosed in quotes.
     '''
-    def __init__(self, layer, dbinfo, queries, clip=True, srid=900913, simplify=1.0, simplify_until=16, padding=0):
+    def __init__(self, layer, dbinfo, queries, clip=True, srid=900913, simplify=1.0, simplify_until=16, padding=0, maxconn=16, strict_intersects=False, simplify_algorithm='dp_topo', prepare_queries=False, twkb=False, id_hash='md5', validate_geometry=True, st_asmvt=False):
         '''
         '''
         self.layer = layer
         
         keys = 'host', 'user', 'password', 'database', 'port', 'dbname'
         self.dbinfo = dict([(k, v) for (k, v) in dbinfo.items() if k in keys])
+        
+        set_pool_size(self.dbinfo, int(maxconn))
 
         self.clip = bool(clip)
         self.srid = int(srid)
         self.simplify = float(simplify)
         self.simplify_until = int(simplify_until)
+        self.simplify_algorithm = simplify_algorithm
+        self.prepare_queries = bool(prepare_queries)
+        self.twkb = bool(twkb)
+        self.id_hash = id_hash
+        self.validate_geometry = bool(validate_geometry)
+        self.st_asmvt = bool(st_asmvt)
+        
+        if simplify_algorithm not in ('dp_topo', 'dp', 'vw'):
+            raise ValueError('Unknown simplify_algorithm, "%s"' % simplify_algorithm)
+        
+        if id_hash not in id_hashes:
+            raise ValueError('Unknown id_hash, "%s"' % id_hash)
+        
+        # simplification tolerance for each zoom, None where it's turned off.
+        self.tolerances = tuple([self.simplify * tolerance if zoom < self.simplify_until and self.simplify else None
+                                 for (zoom, tolerance) in enumerate(tolerances)])
         self.padding = int(padding)
+        self.strict_intersects = bool(strict_intersects)
         self.columns = {}
 
         # Each type creates an iterator yielding tuples of:
@@ -148,38 +294,33 @@ class Provider:
         if isinstance(queries, dict):
             # Add 1 to include space for zoom level 0
             n_zooms = max(int(z) for z in queries) + 1
-            queryiter = ((int(z), q) for z, q in queries.iteritems())
+            queryiter = ((int(z), q) for z, q in queries.items())
         else:  # specified as array
             n_zooms = len(queries)
             queryiter = enumerate(queries)
 
         # For the dict case, unspecified zoom levels are assumed to be null.
+        # Files and URLs are only loaded by get_query() once a zoom is used.
         self.queries = [None] * n_zooms
+        self.query_texts = {}
         for z, query in queryiter:
-            if query is None:
-                continue
+            self.queries[z] = query
+    
+    def get_query(self, zoom):
+        ''' Get the query text for a zoom level, loading files and URLs on first use.
+        '''
+        if zoom >= len(self.queries):
+            zoom = len(self.queries) - 1
         
-            #
-            # might be a file or URL?
-            #
-            url = urljoin(layer.config.dirpath, query)
-            scheme, h, path, p, q, f = urlparse(url)
-            
-            if scheme in ('file', '') and exists(path):
-                query = open(path).read()
-            
-            elif scheme == 'http' and ' ' not in url:
-                query = urlopen(url).read()
+        if zoom not in self.query_texts:
+            self.query_texts[zoom] = load_query(self.queries[zoom], self.layer.config.dirpath)
         
-            self.queries[z] = query
+        return self.query_texts[zoom]
         
     def renderTile(self, width, height, srs, coord):
         ''' Render a single tile, return a Response instance.
         '''
-        try:
-            query = self.queries[coord.zoom]
-        except IndexError:
-            query = self.queries[-1]
+        query = self.get_query(coord.zoom)
 
         ll = self.layer.projection.coordinateProj(coord.down())
         ur = self.layer.projection.coordinateProj(coord.right())
@@ -191,29 +332,17 @@ class Provider:
         if query not in self.columns:
             self.columns[query] = query_columns(self.dbinfo, self.srid, query, bounds)
 
-        if not self.columns[query]:
-            return EmptyResponse(bounds)
-
-        tolerance = self.simplify * tolerances[coord.zoom] if coord.zoom < self.simplify_until else None
+        columns = self.columns[query]
+        tolerance = self.tolerances[coord.zoom] if coord.zoom < len(self.tolerances) else None
         
-        return Response(self.dbinfo, self.srid, query, self.columns[query], bounds, tolerance, coord.zoom, self.clip, coord, self.layer.name(), self.padding)
+        return Response(self.dbinfo, self.srid, query, columns, bounds, tolerance, coord.zoom, self.clip, coord, self.layer.name(), self.padding, self.strict_intersects, self.simplify_algorithm, self.prepare_queries, self.twkb, self.id_hash, self.validate_geometry, self.st_asmvt)
 
     def getTypeByExtension(self, extension):
         ''' Get mime-type and format by file extension, one of "mvt", "json", "topojson" or "pbf".
         '''
-        if extension.lower() == 'mvt':
-            return 'application/octet-stream+mvt', 'MVT'
-        
-        elif extension.lower() == 'json':
-            return 'application/json', 'JSON'
-        
-        elif extension.lower() == 'topojson':
-            return 'application/json', 'TopoJSON'
-
-        elif extension.lower() == 'pbf':
-            return 'application/x-protobuf', 'PBF'
-        
-        else:
+        try:
+            return extension_types[extension.lower()]
+        except KeyError:
             raise ValueError(extension)
 
 class MultiProvider:
@@ -224,6 +353,10 @@ class MultiProvider:
         names:
           List of names of vector-generating layers from elsewhere in config.
         
+        jobs:
+          Optional maximum number of sub-layer tiles loaded at the same time
+          for GeoJSON and TopoJSON responses. Default: all of them at once.
+        
         Sample configuration, for a layer with combined data from water
         and land areas, both assumed to be vector-returning layers:
         
@@ -236,94 +369,238 @@ class MultiProvider:
             }
           }
     '''
-    def __init__(self, layer, names):
+    def __init__(self, layer, names, jobs=None):
         self.layer = layer
         self.names = names
+        self.jobs = None if jobs is None else int(jobs)
         
     def renderTile(self, width, height, srs, coord):
         ''' Render a single tile, return a Response instance.
         '''
-        return MultiResponse(self.layer.config, self.names, coord)
+        return MultiResponse(self.layer.config, self.names, coord, self.jobs)
 
     def getTypeByExtension(self, extension):
         ''' Get mime-type and format by file extension, "json", "topojson" or "pbf" only.
         '''
-        if extension.lower() == 'json':
-            return 'application/json', 'JSON'
-        
-        elif extension.lower() == 'topojson':
-            return 'application/json', 'TopoJSON'
+        try:
+            return multi_extension_types[extension.lower()]
+        except KeyError:
+            raise ValueError(extension)
+
+def load_query(query, dirpath):
+    ''' Get query text for a query that might be a file name or URL.
+    
+        Files and URLs are read on every call, Provider.get_query() keeps
+        the text for as long as the provider lasts.
+    '''
+    if query is None:
+        return None
+    
+    words = query.split(None, 1)
+    
+    if words and words[0].upper() in ('SELECT', 'WITH'):
+        # inline SQL, no need to look for a file or URL.
+        return query
+
+    url = urljoin(dirpath, query)
+    scheme, h, path, p, q, f = urlparse(url)
+    
+    if scheme in ('file', '') and exists(path):
+        return open(path).read()
+    
+    elif scheme in ('http', 'https') and ' ' not in url:
+        body = urlopen(url).read()
+        return body if isinstance(body, str) else body.decode('utf8')
+    
+    return query
 
-        elif extension.lower() == 'pbf':
-            return 'application/x-protobuf', 'PBF'
+def set_pool_size(dbinfo, maxconn):
+    ''' Raise the maximum size of the connection pool for dbinfo to maxconn.
+    
+        Takes effect if the pool has not been created yet by get_pool().
+    '''
+    key = frozenset(dbinfo.items())
+    
+    with _pools_lock:
+        _pool_sizes[key] = max(_pool_sizes.get(key, 1), maxconn)
+
+def get_pool(dbinfo):
+    ''' Get the shared connection pool for dbinfo, creating it if necessary.
+    
+        Returns the pool and a semaphore with one slot per connection, so
+        callers can wait for a free connection instead of exhausting the pool.
+        Pools are per-process, so forked workers don't share sockets.
+    '''
+    size_key = frozenset(dbinfo.items())
+    key = getpid(), size_key
+    
+    with _pools_lock:
+        if key not in _pools:
+            size = _pool_sizes.get(size_key, 16)
+            pool = ThreadedConnectionPool(0, size, **dbinfo)
+            
+            # psycopg2 opens minconn connections up front, and closes returned
+            # connections once minconn are idle. Raising it after creation
+            # opens connections lazily but keeps every returned one for reuse.
+            pool.minconn = size
+            _pools[key] = pool, BoundedSemaphore(size)
         
-        else:
-            raise ValueError(extension)
+        return _pools[key]
 
 class Connection:
     ''' Context manager for Postgres connections.
     
+        Connections are checked out from a pool shared by every Connection
+        with the same dbinfo, and returned to it instead of being closed.
+        Connections found closed on the way out are discarded from the pool.
+        
+        With an itersize, the cursor is a server-side cursor that streams
+        results that many rows at a time instead of all at once.
+    
         See http://www.python.org/dev/peps/pep-0343/
         and http://effbot.org/zone/python-with-statement.htm
     '''
-    def __init__(self, dbinfo):
+    def __init__(self, dbinfo, itersize=None):
         self.dbinfo = dbinfo
+        self.itersize = itersize
     
     def __enter__(self):
-        self.db = connect(**self.dbinfo).cursor(cursor_factory=RealDictCursor)
+        self.pool, self.slots = get_pool(self.dbinfo)
+        self.slots.acquire()
+        
+        try:
+            self.conn = self.pool.getconn()
+        except:
+            self.slots.release()
+            raise
+        
+        if self.itersize:
+            self.db = self.conn.cursor(name='vectiles_%x' % id(self))
+            self.db.itersize = self.itersize
+        else:
+            self.db = self.conn.cursor()
+        
         return self.db
     
     def __exit__(self, type, value, traceback):
-        self.db.connection.close()
+        try:
+            if not self.conn.closed:
+                self.db.close()
+                self.conn.rollback()
+        finally:
+            self.pool.putconn(self.conn, close=bool(self.conn.closed))
+            self.slots.release()
 
 class Response:
     '''
     '''
-    def __init__(self, dbinfo, srid, subquery, columns, bounds, tolerance, zoom, clip, coord, layer_name='', padding=0):
+    def __init__(self, dbinfo, srid, subquery, columns, bounds, tolerance, zoom, clip, coord, layer_name='', padding=0, strict_intersects=False, simplify_algorithm='dp_topo', prepare_queries=False, twkb=False, id_hash='md5', validate_geometry=True, st_asmvt=False):
         ''' Create a new response object with Postgres connection info and a query.
         
             bounds argument is a 4-tuple with (xmin, ymin, xmax, ymax).
         '''
         self.dbinfo = dbinfo
+        self.srid = srid
+        self.subquery = subquery
+        self.columns = columns
         self.bounds = bounds
+        self.tolerance = tolerance
         self.zoom = zoom
         self.clip = clip
         self.coord = coord
         self.layer_name = layer_name
         self.padding = padding
+        self.strict_intersects = strict_intersects
+        self.simplify_algorithm = simplify_algorithm
+        self.prepare_queries = prepare_queries
+        self.twkb = twkb
+        self.id_hash = id_hash
+        self.validate_geometry = validate_geometry
+        self.st_asmvt = st_asmvt
 
         # convert pixel padding to meters (based on tolerances)
         # to be applied in the bbox
         tol_idx = coord.zoom if 0 <= coord.zoom < len(tolerances) else -1
         tol_val = tolerances[tol_idx]
         self.padding = self.padding * tol_val
+        
+        # queries by format, built as needed by get_query().
+        self.query = {}
+
+    def get_query(self, format):
+        ''' Get the PostGIS query for a format, building it on first use.
+        '''
+        if format not in self.query:
+            is_geo, scale, hash_ids = query_formats[format]
+            precision = twkb_precision(is_geo, scale, self.zoom) if self.twkb else None
+            self.query[format] = build_query(self.srid, self.subquery, self.columns, self.bounds, self.tolerance,
+                                             is_geo, self.clip, self.padding, scale, hash_ids, self.strict_intersects,
+                                             self.simplify_algorithm, precision, self.id_hash,
+                                             self.validate_geometry)
+        
+        return self.query[format]
 
-        geo_query = build_query(srid, subquery, columns, bounds, tolerance, True, clip, self.padding)
-        merc_query = build_query(srid, subquery, columns, bounds, tolerance, False, clip, self.padding)
-        pbf_query = build_query(srid, subquery, columns, bounds, tolerance, False, clip, self.padding, pbf.extents)
-        self.query = dict(TopoJSON=geo_query, JSON=geo_query, MVT=merc_query, PBF=pbf_query)
+    def get_prepared_query(self, format):
+        ''' Get the parameterized PostGIS query and its values for a format.
+        '''
+        is_geo, scale, hash_ids = query_formats[format]
+        precision = twkb_precision(is_geo, scale, self.zoom) if self.twkb else None
+        return build_prepared_query(self.srid, self.subquery, self.columns, self.bounds, self.tolerance,
+                                    is_geo, self.clip, self.padding, scale, hash_ids, self.strict_intersects,
+                                    self.simplify_algorithm, precision, self.id_hash,
+                                    self.validate_geometry)
 
     def save(self, out, format):
         '''
         '''
-        with Connection(self.dbinfo) as db:
-            db.execute(self.query[format])
+        if format == 'PBF' and self.st_asmvt:
+            query = build_mvt_query(self.srid, self.subquery, self.columns, self.bounds, self.tolerance,
+                                    self.clip, self.padding, pbf.extents, self.layer_name, self.simplify_algorithm,
+                                    self.validate_geometry)
+            
+            with Connection(self.dbinfo) as db:
+                db.execute(query)
+                tile = db.fetchone()[0]
+            
+            # ST_AsMVT() over no rows is null or empty, both an empty tile.
+            out.write(bytes(tile or b''))
+            return
+        
+        itersize = None if self.prepare_queries else cursor_itersize
+        
+        with Connection(self.dbinfo, itersize) as db:
+            if self.prepare_queries:
+                execute_prepared(db, *self.get_prepared_query(format))
+            else:
+                db.execute(self.get_query(format))
             
             features = []
+            (geom_index, id_index, prop_keys, prop_indexes), rows = fetch_rows(db)
+            strings = {}
             
-            for row in db.fetchall():
-                if row['__geometry__'] is None:
-                    continue
+            try:
+                for row in rows:
+                    if row[geom_index] is None:
+                        continue
+                    
+                    wkb = a2b_base64(row[geom_index])
+                    
+                    if self.twkb:
+                        wkb = twkb.to_wkb(wkb)
+                    
+                    if is_empty(wkb):
+                        continue
+                    
+                    prop = dict(zip(prop_keys, share_strings([row[i] for i in prop_indexes], strings)))
+                    
+                    if id_index is not None:
+                        features.append((wkb, prop, row[id_index]))
+                    
+                    else:
+                        features.append((wkb, prop))
             
-                wkb = bytes(row['__geometry__'])
-                prop = dict([(k, v) for (k, v) in row.items()
-                             if k not in ('__geometry__', '__id__')])
-                
-                if '__id__' in row:
-                    features.append((wkb, prop, row['__id__']))
-                
-                else:
-                    features.append((wkb, prop))
+            finally:
+                rows.close()
 
         if format == 'MVT':
             mvt.encode(out, features)
@@ -332,9 +609,7 @@ class Response:
             geojson.encode(out, features, self.zoom, self.clip)
         
         elif format == 'TopoJSON':
-            ll = SphericalMercator().projLocation(Point(*self.bounds[0:2]))
-            ur = SphericalMercator().projLocation(Point(*self.bounds[2:4]))
-            topojson.encode(out, features, (ll.lon, ll.lat, ur.lon, ur.lat), self.clip)
+            topojson.encode(out, features, lonlat_bounds(self.bounds), self.clip)
         
         elif format == 'PBF':
             pbf.encode(
@@ -359,9 +634,7 @@ class EmptyResponse:
             geojson.encode(out, [], 0, False)
         
         elif format == 'TopoJSON':
-            ll = SphericalMercator().projLocation(Point(*self.bounds[0:2]))
-            ur = SphericalMercator().projLocation(Point(*self.bounds[2:4]))
-            topojson.encode(out, [], (ll.lon, ll.lat, ur.lon, ur.lat), False)
+            topojson.encode(out, [], lonlat_bounds(self.bounds), False)
         
         elif format == 'PBF':
             pbf.encode(out, [], None, layer_name='')
@@ -372,115 +645,539 @@ class EmptyResponse:
 class MultiResponse:
     '''
     '''
-    def __init__(self, config, names, coord):
+    def __init__(self, config, names, coord, jobs=None):
         ''' Create a new response object with TileStache config and layer names.
         '''
         self.config = config
         self.names = names
         self.coord = coord
+        self.jobs = jobs
     
     def save(self, out, format):
         '''
         '''
         if format == 'TopoJSON':
-            topojson.merge(out, self.names, self.config, self.coord)
+            topojson.merge(out, self.names, self.config, self.coord, self.jobs)
         
         elif format == 'JSON':
-            geojson.merge(out, self.names, self.config, self.coord)
+            geojson.merge(out, self.names, self.config, self.coord, self.jobs)
 
         elif format == 'PBF':
-            feature_layers = []
+            tiles = []
             layers = [self.config.layers[name] for name in self.names]
             for layer in layers:
                 width, height = layer.dim, layer.dim
                 tile = layer.provider.renderTile(width, height, layer.projection.srs, self.coord)
                 if isinstance(tile, EmptyResponse): continue
-                feature_layers.append({'name': layer.name(), 'features': get_features(tile.dbinfo, tile.query["PBF"])})
+                tiles.append((layer.name(), tile))
+            feature_layers = get_layer_features(tiles)
             pbf.merge(out, feature_layers, self.coord)
 
         else:
             raise ValueError(format)
 
+def lonlat_bounds(bounds):
+    ''' Convert spherical mercator bounds to (west, south, east, north) degrees.
+    '''
+    ll = _mercator.projLocation(Point(*bounds[0:2]))
+    ur = _mercator.projLocation(Point(*bounds[2:4]))
+    return ll.lon, ll.lat, ur.lon, ur.lat
+
 def query_columns(dbinfo, srid, subquery, bounds):
     ''' Get information about the columns returned for a subquery.
+    
+        Column names are read from the cursor description of a query that
+        returns no rows, so Postgres plans the subquery but never runs it.
     '''
     with Connection(dbinfo) as db:
-        #
-        # While bounds covers less than the full planet, look for just one feature.
-        #
-        while (abs(bounds[2] - bounds[0]) * abs(bounds[2] - bounds[0])) < 1.61e15:
-            bbox = 'ST_MakeBox2D(ST_MakePoint(%f, %f), ST_MakePoint(%f, %f))' % bounds
-            bbox = 'ST_SetSRID(%s, %d)' % (bbox, srid)
+        bbox = 'ST_MakeBox2D(ST_MakePoint(%f, %f), ST_MakePoint(%f, %f))' % bounds
+        bbox = 'ST_SetSRID(%s, %d)' % (bbox, srid)
+    
+        query = subquery.replace('!bbox!', bbox)
+    
+        db.execute('SELECT * FROM (\n%s\n) AS q LIMIT 0' % query) # newlines are important here, to break out of comments.
         
-            query = subquery.replace('!bbox!', bbox)
+        column_names = set([column[0] for column in db.description])
+        return column_names
+
+def column_indexes(description):
+    ''' Get positions of geometry, ID and property columns in a cursor description.
+    
+        Returns geometry index, ID index or None, a list of property names,
+        and a matching list of property column indexes.
+    '''
+    names = [column[0] for column in description]
+    
+    if '__geometry__' not in names:
+        raise Exception("There's supposed to be a __geometry__ column.")
+    
+    geom_index = names.index('__geometry__')
+    id_index = names.index('__id__') if '__id__' in names else None
+    prop_indexes = [i for (i, name) in enumerate(names) if i not in (geom_index, id_index)]
+    prop_keys = [intern(str(names[i])) for i in prop_indexes]
+    
+    return geom_index, id_index, prop_keys, prop_indexes
+
+def share_strings(values, strings):
+    ''' Return a list of values with equal strings replaced by one shared copy.
+    
+        Strings dictionary holds the shared copies, and is kept for a whole tile
+        so repeated property values like "residential" are stored only once.
+    '''
+    return [strings.setdefault(v, v) if isinstance(v, string_types) else v for v in values]
+
+def fetch_rows(db):
+    ''' Get column_indexes() and a read_rows() generator for an executed cursor.
+    
+        Server-side cursors describe their columns only after a first fetch,
+        so the first batch of rows is read right away. The rest are read
+        ahead by read_rows(). A result with no rows has no columns.
         
-            db.execute(query + '\n LIMIT 1') # newline is important here, to break out of comments.
-            row = db.fetchone()
-            
-            if row is None:
-                #
-                # Try zooming out three levels (8x) to look for features.
-                #
-                bounds = (bounds[0] - (bounds[2] - bounds[0]) * 3.5,
-                          bounds[1] - (bounds[3] - bounds[1]) * 3.5,
-                          bounds[2] + (bounds[2] - bounds[0]) * 3.5,
-                          bounds[3] + (bounds[3] - bounds[1]) * 3.5)
+        Close the generator before the cursor, see read_rows().
+    '''
+    rows = db.fetchmany(cursor_itersize)
+    description = column_indexes(db.description) if rows else (None, None, [], [])
+    
+    return description, read_rows(db, rows)
+
+def read_rows(db, rows, depth=4):
+    ''' Generate a first batch of rows, then the rest of a cursor's rows.
+    
+        The rest are fetched by a background thread, up to depth batches
+        ahead, so waiting on Postgres overlaps with whatever the caller
+        does with each row. The thread uses the cursor until the generator
+        is exhausted or closed, so callers that might stop early must call
+        close() while the cursor and its connection are still theirs.
+    '''
+    if not rows:
+        return
+    
+    batches, stopped = Queue(depth), Event()
+    
+    def fetch():
+        try:
+            while not stopped.is_set():
+                rows = db.fetchmany(cursor_itersize)
+                batches.put(rows)
                 
-                continue
+                if not rows:
+                    break
+        except Exception as e:
+            batches.put(e)
+    
+    thread = Thread(target=fetch)
+    thread.daemon = True
+    thread.start()
+    
+    try:
+        while rows:
+            for row in rows:
+                yield row
+            
+            rows = batches.get()
             
-            column_names = set(row.keys())
-            return column_names
+            if isinstance(rows, Exception):
+                raise rows
+    
+    finally:
+        # Let a fetch in progress finish, and the thread end, before the
+        # cursor is closed and its connection goes back to the pool.
+        stopped.set()
+        
+        while thread.is_alive():
+            try:
+                batches.get(timeout=.1)
+            except Empty:
+                pass
+        
+        thread.join()
+
+def read_retrying(dbinfo, query, read):
+    ''' Execute a query on a server-side cursor and return read(cursor).
+    
+        Queries failing on a serialization conflict are tried again after
+        each delay in retry_delays, and the last failure is raised. The
+        connection goes back to the pool before each wait, so a waiting
+        query holds no connection.
+    '''
+    for delay in retry_delays + (None, ):
+        with Connection(dbinfo, cursor_itersize) as db:
+            try:
+                db.execute(query)
+                return read(db)
+            except TransactionRollbackError:
+                if delay is None:
+                    raise
+        
+        sleep(delay)
+
+def get_features(dbinfo, query, is_twkb=False):
+    ''' Get a list of (WKB, properties, ID) features for a query.
+    
+        Set is_twkb for queries that select TWKB geometries, such as those
+        from Response.get_query() with the twkb option.
+    '''
+    return read_retrying(dbinfo, query, lambda db: read_features(db, is_twkb))
 
-def get_features(dbinfo, query, n_try=1):
+def read_features(db, is_twkb=False):
     features = []
+    (geom_index, id_index, prop_keys, prop_indexes), rows = fetch_rows(db)
+    assert id_index is not None or geom_index is None, 'Missing __id__ in feature result'
+    strings = {}
 
-    with Connection(dbinfo) as db:
-        try:
-            db.execute(query)
-        except TransactionRollbackError:
-            if n_try >= 5:
-                raise
-            else:
-                return get_features(dbinfo, query, n_try=n_try + 1)
-        for row in db.fetchall():
-            assert '__geometry__' in row, 'Missing __geometry__ in feature result'
-            assert '__id__' in row, 'Missing __id__ in feature result'
+    try:
+        for row in rows:
+            if row[geom_index] is None:
+                continue
+
+            wkb = a2b_base64(row[geom_index])
+
+            if is_twkb:
+                wkb = twkb.to_wkb(wkb)
+
+            if is_empty(wkb):
+                continue
 
-            wkb = bytes(row.pop('__geometry__'))
-            id = row.pop('__id__')
+            id = row[id_index]
 
-            props = dict((k, v) for k, v in row.items() if v is not None)
+            values = share_strings([row[i] for i in prop_indexes], strings)
+            props = dict((k, v) for (k, v) in zip(prop_keys, values) if v is not None)
 
             features.append((wkb, props, id))
 
+    finally:
+        rows.close()
+
+    return features
+
+
+def get_layer_features(tiles):
+    ''' Get PBF features for a list of (layer name, Response) pairs.
+    
+        Layers sharing a dbinfo are read together with one query from
+        build_union_query(). Layers from different databases are read
+        at the same time, one thread for each database after the first.
+        Returns a list of layer dictionaries with "name" and "features"
+        keys, ready for pbf.merge().
+    '''
+    feature_layers = [{'name': name, 'features': []} for (name, tile) in tiles]
+    groups = {}
+    
+    for (feature_layer, (name, tile)) in zip(feature_layers, tiles):
+        group = groups.setdefault(frozenset(tile.dbinfo.items()), (tile.dbinfo, [], [], set()))
+        group[1].append(feature_layer['features'])
+        group[2].append((tile.get_query('PBF'), tile.columns))
+        
+        if tile.twkb:
+            # this layer's geometries come back as TWKB, see get_query().
+            group[3].add(len(group[2]) - 1)
+    
+    groups = list(groups.values())
+    results, errors = [None] * len(groups), []
+    
+    def read_group(index):
+        try:
+            dbinfo, layer_features, queries, twkb_indexes = groups[index]
+            results[index] = get_union_features(dbinfo, build_union_query(queries), twkb_indexes)
+        except Exception as e:
+            errors.append(e)
+    
+    threads = [Thread(target=read_group, args=(index, )) for index in range(1, len(groups))]
+    
+    for thread in threads:
+        thread.start()
+    
+    if groups:
+        read_group(0)
+    
+    for thread in threads:
+        thread.join()
+    
+    if errors:
+        raise errors[0]
+    
+    for ((dbinfo, layer_features, queries, twkb_indexes), features) in zip(groups, results):
+        for (index, feature) in features:
+            layer_features[index].append(feature)
+    
+    return feature_layers
+
+def get_union_features(dbinfo, query, twkb_indexes=()):
+    ''' Get a list of (query index, feature) pairs for a build_union_query() query.
+    
+        Geometries from the queries at twkb_indexes are read as TWKB.
+    '''
+    return read_retrying(dbinfo, query, lambda db: read_union_features(db, twkb_indexes))
+
+def read_union_features(db, twkb_indexes=()):
+    features = []
+    rows = read_rows(db, db.fetchmany(cursor_itersize))
+
+    try:
+        for (index, geometry, properties) in rows:
+            if geometry is None:
+                continue
+
+            wkb = a2b_base64(geometry)
+
+            if index in twkb_indexes:
+                wkb = twkb.to_wkb(wkb)
+
+            if is_empty(wkb):
+                continue
+
+            values = dict((k, typecast(v, db)) for (k, v) in properties.items())
+            id = values.pop('__id__')
+
+            props = dict((k, v) for (k, v) in values.items() if v is not None)
+
+            features.append((index, (wkb, props, id)))
+
+    finally:
+        rows.close()
+
     return features
 
+def typecast(value, db):
+    ''' Convert a type OID and text pair from build_union_query() to a Python value.
+    
+        Uses the typecaster psycopg2 would pick for a column of that type,
+        looking at the cursor, its connection, and then the global ones.
+    '''
+    oid, text = value
+    
+    if text is None:
+        return None
+    
+    oid = int(oid)
+    connection = getattr(db, 'connection', None)
+    
+    for casters in (getattr(db, 'string_types', {}), getattr(connection, 'string_types', {}), typecasters):
+        if oid in casters:
+            return casters[oid](text, db)
+    
+    return text
+
+def build_union_query(queries):
+    ''' Build one PostGIS query for a list of (query, columns) pairs.
+    
+        Queries come from build_query() and columns from query_columns().
+        Each result row has the index of its query in the list, a geometry,
+        and a JSON object of the feature ID and properties, so queries with
+        different columns can share one UNION ALL.
+        
+        JSON would turn numeric, date and other values into plain numbers
+        and strings, so each value is sent as its type OID and text instead,
+        for typecast() to read like any other column.
+    '''
+    selects = []
+    
+    for (index, (query, columns)) in enumerate(queries):
+        names = ['__id__'] + sorted([c for c in columns if c not in ('__geometry__', '__id__')])
+        props = ', '.join(['ARRAY[pg_typeof(t."%s")::oid::text, t."%s"::text] AS "%s"' % (c, c, c) for c in names])
+        
+        selects.append('''SELECT %(index)d AS __layer__, t.__geometry__,
+                     (SELECT row_to_json(p) FROM (SELECT %(props)s) AS p) AS __properties__
+              FROM (
+                %(query)s
+                ) AS t''' % locals())
+    
+    return '\nUNION ALL\n'.join(selects)
         
-def build_query(srid, subquery, subcolumns, bounds, tolerance, is_geo, is_clipped, padding=0, scale=None):
+def build_query(srid, subquery, subcolumns, bounds, tolerance, is_geo, is_clipped, padding=0, scale=None, hash_ids=True, strict_intersects=False, simplify_algorithm='dp_topo', twkb_precision=None, id_hash='md5', validate_geometry=True):
     ''' Build and return an PostGIS query.
+    
+        Queries are filled in from templates made once by build_query_template().
+        Without hash_ids, no "__id__" column is added for subqueries lacking one.
+        Without strict_intersects, clipped features are only matched by
+        bounding box, and those clipped to nothing are skipped when read.
+        Simplify_algorithm is "dp_topo" or "vw", see Provider for details.
     '''
-    bbox = 'ST_MakeBox2D(ST_MakePoint(%.12f, %.12f), ST_MakePoint(%.12f, %.12f))' % (
-        bounds[0] - padding, bounds[1] - padding,
-        bounds[2] + padding, bounds[3] + padding)
+    key = srid, subquery, frozenset(subcolumns), tolerance, is_geo, is_clipped, scale, hash_ids, strict_intersects, simplify_algorithm, twkb_precision, id_hash, validate_geometry
+    template = query_template(key, build_query_template, key)
+    
+    values = query_values(bounds, padding, scale)
+    bbox = 'ST_MakeBox2D(ST_MakePoint(%.12f, %.12f), ST_MakePoint(%.12f, %.12f))' % tuple(values[:4])
+    query = template.replace('!bbox!', bbox)
 
-    bbox = 'ST_SetSRID(%s, %d)' % (bbox, srid)
-    geom = 'q.__geometry__'
+    if scale:
+        query = query.replace('!transscale!', '%.12f, %.12f, %.12f, %.12f' % tuple(values[4:]))
+    
+    return query
+
+def build_prepared_query(srid, subquery, subcolumns, bounds, tolerance, is_geo, is_clipped, padding=0, scale=None, hash_ids=True, strict_intersects=False, simplify_algorithm='dp_topo', twkb_precision=None, id_hash='md5', validate_geometry=True):
+    ''' Build and return a PostGIS query with $n parameters, and their values.
+    
+        Takes the same arguments as build_query(). Bounds and scale become
+        float8 parameters, so the query is the same for every tile.
+    '''
+    key = srid, subquery, frozenset(subcolumns), tolerance, is_geo, is_clipped, scale, hash_ids, strict_intersects, simplify_algorithm, twkb_precision, id_hash, validate_geometry
+    template = query_template(key, build_query_template, key)
+    
+    values = query_values(bounds, padding, scale)
+    bbox = 'ST_MakeBox2D(ST_MakePoint($1, $2), ST_MakePoint($3, $4))'
+    query = template.replace('!bbox!', bbox)
+
+    if scale:
+        query = query.replace('!transscale!', '$5, $6, $7, $8')
+    
+    return query, values
+
+def query_template(key, build, args):
+    ''' Get a query template for a key, calling build(*args) if it's not cached.
+    
+        The most recently used templates are kept, so layers whose queries
+        change, e.g. after config reloads, don't grow the cache for ever.
+    '''
+    with _query_templates_lock:
+        template = _query_templates.pop(key, None)
+        
+        if template is None:
+            template = build(*args)
+        
+        _query_templates[key] = template
+        
+        while len(_query_templates) > _query_templates_max:
+            _query_templates.popitem(last=False)
+    
+    return template
+
+def query_values(bounds, padding, scale):
+    ''' Get padded bbox corner values, and ST_TransScale values if scale is given.
+    '''
+    values = [bounds[0] - padding, bounds[1] - padding,
+              bounds[2] + padding, bounds[3] + padding]
+    
+    if scale:
+        # scale applies to the un-padded bounds, e.g. geometry in the padding area "spills over" past the scale range
+        values += [-bounds[0], -bounds[1],
+                   scale / (bounds[2] - bounds[0]),
+                   scale / (bounds[3] - bounds[1])]
+    
+    return values
+
+def twkb_precision(is_geo, scale, zoom):
+    ''' Get ST_AsTWKB() decimal digits good to ~1/4 pixel for a query format.
+    '''
+    if scale:
+        # ST_TransScale() output is already in tile pixel units.
+        return 0
+    
+    elif is_geo:
+        return min(7, geojson.precisions[min(zoom, len(geojson.precisions) - 1)])
+    
+    # spherical mercator meters, four per pixel.
+    digits = int(ceil(log10(4 * 2 ** (zoom + 8) / (2 * pi * 6378137))))
+    return max(-7, min(7, digits))
+
+def execute_prepared(db, query, values):
+    ''' Execute a query with $n float8 parameters as a prepared statement.
+    
+        Statements are prepared once per connection, and named for their text.
+    '''
+    name = 'vectiles_%s' % md5(query.encode('utf8')).hexdigest()[:16]
+    
+    with _prepared_lock:
+        prepared = _prepared.setdefault(db.connection, set())
+    
+    if name not in prepared:
+        types = ', '.join(['float8'] * len(values))
+        db.execute('PREPARE %s(%s) AS %s' % (name, types, query))
+        prepared.add(name)
+    
+    db.execute('EXECUTE %s(%s)' % (name, ', '.join(['%s'] * len(values))), values)
+
+def simplified(geom, tolerance, simplify_algorithm):
+    ''' Wrap a geometry SQL expression in the simplification for a tolerance.
+    '''
+    if tolerance is None:
+        return geom
+    
+    elif simplify_algorithm == 'vw':
+        return 'ST_SimplifyVW(%s, %.2f)' % (geom, tolerance * tolerance)
+    
+    elif simplify_algorithm == 'dp':
+        return 'ST_Simplify(%s, %.2f)' % (geom, tolerance)
+    
+    return 'ST_SimplifyPreserveTopology(%s, %.2f)' % (geom, tolerance)
+
+def build_mvt_query(srid, subquery, subcolumns, bounds, tolerance, is_clipped, padding, extent, layer_name, simplify_algorithm='dp_topo', validate_geometry=True):
+    ''' Build and return a PostGIS query for a whole PBF tile from ST_AsMVT().
+    
+        Needs PostGIS 2.4+. Generated feature IDs are left out, because
+        ST_AsMVT() only takes a feature ID column from PostGIS 3.0.
+    '''
+    key = 'ST_AsMVT', srid, subquery, frozenset(subcolumns), tolerance, is_clipped, extent, layer_name, simplify_algorithm, validate_geometry
+    template = query_template(key, build_mvt_query_template, key[1:])
+    
+    values = query_values(bounds, padding, None)
+    bbox = 'ST_MakeBox2D(ST_MakePoint(%.12f, %.12f), ST_MakePoint(%.12f, %.12f))' % tuple(values)
+    tilebox = 'ST_MakeBox2D(ST_MakePoint(%.12f, %.12f), ST_MakePoint(%.12f, %.12f))' % tuple(bounds)
+    buffer = int(round(padding * extent / (bounds[2] - bounds[0])))
+    
+    query = template.replace('!bbox!', bbox).replace('!tilebox!', tilebox)
+    return query.replace('!buffer!', str(buffer))
+
+def build_mvt_query_template(srid, subquery, subcolumns, tolerance, is_clipped, extent, layer_name, simplify_algorithm, validate_geometry):
+    ''' Build and return an ST_AsMVT() query with "!bbox!", "!tilebox!" and "!buffer!" tokens.
+    
+        The bbox token stands for the padded tile bounds box, the tilebox
+        token for the unpadded box, and buffer for padding in tile units.
+    '''
+    bbox = 'ST_SetSRID(!bbox!, %d)' % srid
+    geom = 'ST_MakeValid(q.__geometry__)' if validate_geometry else 'q.__geometry__'
+    geom = simplified(geom, tolerance, simplify_algorithm)
+    clip = 'true' if is_clipped else 'false'
+    name = layer_name.replace("'", "''")
+    
+    subquery = subquery.replace('!bbox!', bbox)
+    columns = ['q."%s", ' % c for c in subcolumns if c not in ('__geometry__', '__id__')]
+    
+    if '__geometry__' not in subcolumns:
+        raise Exception("There's supposed to be a __geometry__ column.")
+    
+    columns = ''.join(columns)
+    
+    return '''SELECT ST_AsMVT(t, '%(name)s', %(extent)d, '__geometry__')
+              FROM (
+                SELECT %(columns)sST_AsMVTGeom(%(geom)s, !tilebox!, %(extent)d, !buffer!, %(clip)s) AS __geometry__
+                FROM (
+                  %(subquery)s
+                  ) AS q
+                WHERE q.__geometry__ && %(bbox)s
+                ) AS t''' \
+            % locals()
+
+def build_query_template(srid, subquery, subcolumns, tolerance, is_geo, is_clipped, scale, hash_ids, strict_intersects, simplify_algorithm, twkb_precision, id_hash, validate_geometry):
+    ''' Build and return an PostGIS query with "!bbox!" and "!transscale!" tokens.
+    
+        The bbox token stands for the padded tile bounds box, without an SRID.
+        Geometry WKB is sent base64-encoded, a third smaller on the wire
+        than the hex text Postgres otherwise uses for bytea. Geometry is
+        sent as TWKB instead if twkb_precision is not None.
+    '''
+    bbox = 'ST_SetSRID(!bbox!, %d)' % srid
+    
+    # repaired the same way whether it's clipped, contained or unclipped.
+    geom = 'ST_MakeValid(q.__geometry__)' if validate_geometry else 'q.__geometry__'
     
     if is_clipped:
-        geom = 'ST_Intersection(%s, %s)' % (geom, bbox)
+        # Geometries with a bounding box inside the tile need no clipping.
+        geom = 'CASE WHEN q.__geometry__ @ %s THEN %s ELSE ST_Intersection(%s, %s) END' \
+             % (bbox, geom, geom, bbox)
     
-    if tolerance is not None:
-        geom = 'ST_SimplifyPreserveTopology(%s, %.2f)' % (geom, tolerance)
+    geom = simplified(geom, tolerance, simplify_algorithm)
     
     if is_geo:
         geom = 'ST_Transform(%s, 4326)' % geom
 
     if scale:
-        # scale applies to the un-padded bounds, e.g. geometry in the padding area "spills over" past the scale range
-        geom = ('ST_TransScale(%s, %.12f, %.12f, %.12f, %.12f)'
-                % (geom, -bounds[0], -bounds[1],
-                   scale / (bounds[2] - bounds[0]),
-                   scale / (bounds[3] - bounds[1])))
+        geom = 'ST_TransScale(%s, !transscale!)' % geom
+    
+    if twkb_precision is None:
+        geom = 'ST_AsBinary(%s)' % geom
+    else:
+        geom = 'ST_AsTWKB(%s, %d)' % (geom, twkb_precision)
     
     subquery = subquery.replace('!bbox!', bbox)
     columns = ['q."%s"' % c for c in subcolumns if c not in ('__geometry__', )]
@@ -488,17 +1185,22 @@ def build_query(srid, subquery, subcolumns, bounds, tolerance, is_geo, is_clippe
     if '__geometry__' not in subcolumns:
         raise Exception("There's supposed to be a __geometry__ column.")
     
-    if '__id__' not in subcolumns:
-        columns.append('Substr(MD5(ST_AsBinary(q.__geometry__)), 1, 10) AS __id__')
+    if hash_ids and '__id__' not in subcolumns:
+        columns.append('%s AS __id__' % id_hashes[id_hash])
     
     columns = ', '.join(columns)
     
+    if strict_intersects or not is_clipped:
+        # only clipping empties features that miss the tile, so they can be skipped.
+        intersects = 'AND ST_Intersects(q.__geometry__, %s)' % bbox
+    else:
+        intersects = ''
+    
     return '''SELECT %(columns)s,
-                     ST_AsBinary(%(geom)s) AS __geometry__
+                     encode(%(geom)s, 'base64') AS __geometry__
               FROM (
                 %(subquery)s
                 ) AS q
-              WHERE ST_IsValid(q.__geometry__)
-                AND q.__geometry__ && %(bbox)s
-                AND ST_Intersects(q.__geometry__, %(bbox)s)''' \
+              WHERE q.__geometry__ && %(bbox)s
+                %(intersects)s''' \
             % locals()
@@ -0,0 +1,48 @@
+''' Loading of sub-layer tiles for merged VecTiles responses.
+
+GeoJSON and TopoJSON merge() functions both gather tiles from other layers in
+the same TileStache configuration. Use load_tiles() to fetch them all at once.
+'''
+
+from threading import Thread
+
+from ... import getTile
+
+def load_tiles(layers, coord, extension, jobs=None):
+    ''' Retrieve a list of (mime-type, body) tile responses for a list of layers.
+
+        Sub-layer tiles are fetched by up to jobs concurrent threads, so that
+        slow layers overlap each other. Responses are returned in layer order.
+        Without jobs, every layer gets its own thread.
+    '''
+    if len(layers) < 2 or jobs == 1:
+        return [getTile(layer, coord, extension) for layer in layers]
+
+    queue = list(enumerate(layers))
+    responses, errors = [None] * len(layers), []
+
+    def load_tile():
+        while queue and not errors:
+            try:
+                index, layer = queue.pop()
+            except IndexError:
+                # All done.
+                break
+
+            try:
+                responses[index] = getTile(layer, coord, extension)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [Thread(target=load_tile) for i in range(min(jobs or len(layers), len(layers)))]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return responses
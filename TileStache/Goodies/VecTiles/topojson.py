@@ -1,10 +1,22 @@
 from shapely.wkb import loads
 import json
 
-from ... import getTile
+try:
+    from shapely import from_wkb, get_coordinates
+except ImportError:
+    # Shapely 1.x, where encode() handles one geometry or point at a time.
+    from_wkb = None
+
+try:
+    import numpy
+except ImportError:
+    # numpy is optional, diff_encode() quantizes one point at a time without it.
+    numpy = None
+
 from ...Core import KnownUnknown
+from .sublayers import load_tiles
 
-def get_tiles(names, config, coord):
+def get_tiles(names, config, coord, jobs=None):
     ''' Retrieve a list of named TopoJSON layer tiles from a TileStache config.
     
         Check integrity and compatibility of each, looking at known layers,
@@ -17,7 +29,7 @@ def get_tiles(names, config, coord):
         raise KnownUnknown("%s.get_tiles didn't recognize %s when trying to load %s." % (__name__, ', '.join(unknown_layers), ', '.join(names)))
     
     layers = [config.layers[name] for name in names]
-    mimes, bodies = zip(*[getTile(layer, coord, 'topojson') for layer in layers])
+    mimes, bodies = zip(*load_tiles(layers, coord, 'topojson', jobs))
     bad_mimes = [(name, mime) for (mime, name) in zip(mimes, names) if not mime.endswith('/json')]
     
     if bad_mimes:
@@ -37,40 +49,30 @@ def get_tiles(names, config, coord):
     
     return topojsons
 
-def update_arc_indexes(geometry, merged_arcs, old_arcs):
-    ''' Updated geometry arc indexes, and add arcs to merged_arcs along the way.
+# nesting depth of arc index lists in TopoJSON geometries of each type.
+arc_depths = {'Point': 0, 'MultiPoint': 0, 'LineString': 1, 'Polygon': 2,
+              'MultiLineString': 2, 'MultiPolygon': 3}
+
+def shift_arc_indexes(geometry, offset):
+    ''' Shift geometry arc indexes by offset, for arcs appended to a merged list.
     
-        Arguments are modified in-place, and nothing is returned.
+        Geometry is modified in-place, and nothing is returned.
     '''
-    if geometry['type'] in ('Point', 'MultiPoint'):
-        return
+    if geometry['type'] not in arc_depths:
+        raise NotImplementedError("Can't do %s geometries" % geometry['type'])
     
-    elif geometry['type'] == 'LineString':
-        for (arc_index, old_arc) in enumerate(geometry['arcs']):
-            geometry['arcs'][arc_index] = len(merged_arcs)
-            merged_arcs.append(old_arcs[old_arc])
-    
-    elif geometry['type'] == 'Polygon':
-        for ring in geometry['arcs']:
-            for (arc_index, old_arc) in enumerate(ring):
-                ring[arc_index] = len(merged_arcs)
-                merged_arcs.append(old_arcs[old_arc])
-    
-    elif geometry['type'] == 'MultiLineString':
-        for part in geometry['arcs']:
-            for (arc_index, old_arc) in enumerate(part):
-                part[arc_index] = len(merged_arcs)
-                merged_arcs.append(old_arcs[old_arc])
-    
-    elif geometry['type'] == 'MultiPolygon':
-        for part in geometry['arcs']:
-            for ring in part:
-                for (arc_index, old_arc) in enumerate(ring):
-                    ring[arc_index] = len(merged_arcs)
-                    merged_arcs.append(old_arcs[old_arc])
+    depth = arc_depths[geometry['type']]
     
-    else:
-        raise NotImplementedError("Can't do %s geometries" % geometry['type'])
+    if depth:
+        geometry['arcs'] = _shift_arcs(geometry['arcs'], depth, offset)
+
+def _shift_arcs(arcs, depth, offset):
+    ''' Shift a nested list of arc indexes; negative ones are reversed arcs.
+    '''
+    if depth > 1:
+        return [_shift_arcs(part, depth - 1, offset) for part in arcs]
+    
+    return [index + offset if index >= 0 else index - offset for index in arcs]
 
 def get_transform(bounds, size=1024):
     ''' Return a TopoJSON transform dictionary and a point-transforming function.
@@ -87,15 +89,151 @@ def get_transform(bounds, size=1024):
     
     return dict(translate=(tx, ty), scale=(sx, sy)), forward
 
+# shortest line for which diff_encode() uses numpy, below this it's slower.
+numpy_min_points = 32
+
 def diff_encode(line, transform):
     ''' Differentially encode a shapely linestring or ring.
+    
+        Transform is a TopoJSON transform dictionary from get_transform().
+    '''
+    (tx, ty), (sx, sy) = transform['translate'], transform['scale']
+    
+    if numpy is not None and len(line.coords) >= numpy_min_points:
+        return _diff_encode_array(numpy.asarray(line.coords, dtype=float), tx, ty, sx, sy)
+    
+    return _diff_encode_xy(line.coords, tx, ty, sx, sy)
+
+def _diff_encode_array(coords, tx, ty, sx, sy):
+    ''' Quantize and differentially encode an n x 2 numpy array of coordinates.
+    
+        Same values as _diff_encode_xy(), returned as an m x 2 integer array
+        so long arcs are never boxed into Python tuples; dumps() writes them.
+        numpy.rint() rounds halves to even just like Python 3 round() does.
+    '''
+    qx = numpy.rint((coords[:, 0] - tx) / sx).astype(numpy.int64)
+    qy = numpy.rint((coords[:, 1] - ty) / sy).astype(numpy.int64)
+    dx, dy = numpy.diff(qx), numpy.diff(qy)
+    moved = (dx != 0) | (dy != 0)
+    
+    arc = numpy.empty((int(moved.sum()) + 1, 2), dtype=numpy.int64)
+    arc[0] = qx[0], qy[0]
+    arc[1:, 0], arc[1:, 1] = dx[moved], dy[moved]
+    
+    return arc
+
+def _diff_encode_xy(coords, tx, ty, sx, sy):
+    ''' Quantize and differentially encode a sequence of (x, y) coordinates.
+    
+        Quantization and differencing happen together in a single pass,
+        so no intermediate lists of absolute coordinates are built.
+    '''
+    arc, px, py = [], None, None
+    
+    for (x, y) in coords:
+        qx, qy = int(round((x - tx) / sx)), int(round((y - ty) / sy))
+        
+        if px is None:
+            arc.append((qx, qy))
+        
+        elif qx != px or qy != py:
+            arc.append((qx - px, qy - py))
+        
+        px, py = qx, qy
+    
+    return arc
+
+def encode_arcs(lines, transform):
+    ''' Differentially encode a list of shapely linestrings and rings.
+    
+        With Shapely 2 and numpy, coordinates of every line in a tile are
+        quantized and differenced together, and split into one arc per line
+        afterwards. Tiles full of small polygons then cost a few array calls
+        instead of one diff_encode() call per ring.
+    '''
+    if from_wkb is None or numpy is None or not lines:
+        return [diff_encode(line, transform) for line in lines]
+    
+    (tx, ty), (sx, sy) = transform['translate'], transform['scale']
+    coords, index = get_coordinates(lines, return_index=True)
+    points = numpy.rint((coords - (tx, ty)) / (sx, sy)).astype(numpy.int64)
+    
+    # the first point of each line stays absolute, the rest are differences.
+    starts = numpy.ones(len(index), dtype=bool)
+    starts[1:] = index[1:] != index[:-1]
+    diffs = numpy.empty_like(points)
+    diffs[1:] = points[1:] - points[:-1]
+    diffs[starts] = points[starts]
+    
+    keep = starts | (diffs[:, 0] != 0) | (diffs[:, 1] != 0)
+    counts = numpy.bincount(index[keep], minlength=len(lines))
+    
+    return numpy.split(diffs[keep], numpy.cumsum(counts)[:-1])
+
+def encode_point(shape, geometry, arcs, transform, forward):
+    geometry['coordinates'] = forward(shape.x, shape.y)
+
+def encode_line(shape, geometry, lines, transform, forward):
+    geometry['arcs'] = [len(lines)]
+    lines.append(shape)
+
+def encode_polygon(shape, geometry, lines, transform, forward):
+    geometry['arcs'] = polygon_rings(shape, lines)
+
+def encode_multipoint(shape, geometry, lines, transform, forward):
+    if from_wkb is None:
+        geometry['coordinates'] = [forward(point.x, point.y) for point in shape.geoms]
+        return
+    
+    # same arithmetic as forward(), on all the points at once.
+    (tx, ty), (sx, sy) = transform['translate'], transform['scale']
+    xys = get_coordinates(shape)
+    geometry['coordinates'] = numpy.rint((xys - (tx, ty)) / (sx, sy)).astype(numpy.int64).tolist()
+
+def encode_multiline(shape, geometry, lines, transform, forward):
+    geometry['arcs'] = line_arcs = []
+    
+    for line in shape.geoms:
+        line_arcs.append([len(lines)])
+        lines.append(line)
+
+def encode_multipolygon(shape, geometry, lines, transform, forward):
+    geometry['arcs'] = [polygon_rings(polygon, lines) for polygon in shape.geoms]
+
+def polygon_rings(polygon, lines):
+    ''' Add each ring of a polygon to the lines list, return their arc indexes.
     '''
-    coords = [transform(x, y) for (x, y) in line.coords]
+    polygon_arcs = []
     
-    pairs = zip(coords[:], coords[1:])
-    diffs = [(x2 - x1, y2 - y1) for ((x1, y1), (x2, y2)) in pairs]
+    for ring in [polygon.exterior] + list(polygon.interiors):
+        polygon_arcs.append([len(lines)])
+        lines.append(ring)
     
-    return coords[:1] + [(x, y) for (x, y) in diffs if (x, y) != (0, 0)]
+    return polygon_arcs
+
+# encode() functions for each geometry type, called with a shape, its output
+# geometry dictionary, the list of lines that become arcs via encode_arcs(),
+# and the transform and forward function.
+shape_encoders = {'Point': encode_point, 'LineString': encode_line, 'Polygon': encode_polygon,
+                  'MultiPoint': encode_multipoint, 'MultiLineString': encode_multiline,
+                  'MultiPolygon': encode_multipolygon}
+
+def dumps(topology):
+    ''' Serialize a TopoJSON dictionary to compact UTF-8 encoded bytes.
+    
+        Arcs may be lists of pairs or numpy integer arrays from encode_arcs().
+        Only the standard library encoder is used, so tiles come out the same
+        whichever JSON libraries are installed.
+    '''
+    return json.dumps(topology, separators=(',', ':'), default=_array_list).encode('utf8')
+
+def _array_list(value):
+    ''' Convert numpy arcs to lists for the standard library JSON encoder.
+    '''
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return value.tolist()
+    
+    raise TypeError('%r is not JSON serializable' % (value, ))
 
 def decode(file):
     ''' Stub function to decode a TopoJSON file into a list of features.
@@ -108,73 +246,43 @@ def encode(file, features, bounds, is_clipped):
     ''' Encode a list of (WKB, property dict) features into a TopoJSON stream.
     
         Also accept three-element tuples as features: (WKB, property dict, id).
+        WKB may be any bytes-like object, such as a memoryview.
     
         Geometries in the features list are assumed to be unprojected lon, lats.
         Bounds are given in geographic coordinates as (xmin, ymin, xmax, ymax).
     '''
     transform, forward = get_transform(bounds)
-    geometries, arcs = list(), list()
+    geometries, lines = list(), list()
+    add_geometry = geometries.append
     
-    for feature in features:
-        shape = loads(feature[0])
-        geometry = dict(properties=feature[1])
-        geometries.append(geometry)
-        
-        if is_clipped:
-            geometry.update(dict(clipped=True))
-        
-        if len(feature) >= 2:
-            # ID is an optional third element in the feature tuple
-            geometry.update(dict(id=feature[2]))
+    if from_wkb is not None:
+        # parse every geometry in one vectorized call.
+        shapes = from_wkb([bytes(feature[0]) for feature in features])
+    else:
+        shapes = [loads(bytes(feature[0])) for feature in features]
+    
+    for (feature, shape) in zip(features, shapes):
+        shape_type = shape.geom_type
         
-        if shape.type == 'GeometryCollection':
-            geometries.pop()
+        if shape_type == 'GeometryCollection':
             continue
-    
-        elif shape.type == 'Point':
-            geometry.update(dict(type='Point', coordinates=forward(shape.x, shape.y)))
-    
-        elif shape.type == 'LineString':
-            geometry.update(dict(type='LineString', arcs=[len(arcs)]))
-            arcs.append(diff_encode(shape, forward))
-    
-        elif shape.type == 'Polygon':
-            geometry.update(dict(type='Polygon', arcs=[]))
-
-            rings = [shape.exterior] + list(shape.interiors)
-            
-            for ring in rings:
-                geometry['arcs'].append([len(arcs)])
-                arcs.append(diff_encode(ring, forward))
         
-        elif shape.type == 'MultiPoint':
-            geometry.update(dict(type='MultiPoint', coordinates=[]))
-            
-            for point in shape.geoms:
-                geometry['coordinates'].append(forward(point.x, point.y))
+        geometry = dict(type=shape_type, properties=feature[1])
         
-        elif shape.type == 'MultiLineString':
-            geometry.update(dict(type='MultiLineString', arcs=[]))
-            
-            for line in shape.geoms:
-                geometry['arcs'].append([len(arcs)])
-                arcs.append(diff_encode(line, forward))
+        if is_clipped:
+            geometry['clipped'] = True
         
-        elif shape.type == 'MultiPolygon':
-            geometry.update(dict(type='MultiPolygon', arcs=[]))
-            
-            for polygon in shape.geoms:
-                rings = [polygon.exterior] + list(polygon.interiors)
-                polygon_arcs = []
-                
-                for ring in rings:
-                    polygon_arcs.append([len(arcs)])
-                    arcs.append(diff_encode(ring, forward))
-            
-                geometry['arcs'].append(polygon_arcs)
+        if len(feature) > 2:
+            # ID is an optional third element in the feature tuple
+            geometry['id'] = feature[2]
+        
+        if shape_type not in shape_encoders:
+            raise NotImplementedError("Can't do %s geometries" % shape_type)
         
-        else:
-            raise NotImplementedError("Can't do %s geometries" % shape.type)
+        shape_encoders[shape_type](shape, geometry, lines, transform, forward)
+        add_geometry(geometry)
+    
+    arcs = encode_arcs(lines, transform)
     
     result = {
         'type': 'Topology',
@@ -188,14 +296,14 @@ def encode(file, features, bounds, is_clipped):
         'arcs': arcs
         }
     
-    file.write(json.dumps(result, separators=(',', ':')).encode('utf8'))
+    file.write(dumps(result))
 
-def merge(file, names, config, coord):
+def merge(file, names, config, coord, jobs=None):
     ''' Retrieve a list of TopoJSON tile responses and merge them into one.
     
         get_tiles() retrieves data and performs basic integrity checks.
     '''
-    inputs = get_tiles(names, config, coord)
+    inputs = get_tiles(names, config, coord, jobs)
     
     output = {
         'type': 'Topology',
@@ -205,6 +313,9 @@ def merge(file, names, config, coord):
         }
     
     for (name, input) in zip(names, inputs):
+        offset = len(output['arcs'])
+        output['arcs'].extend(input['arcs'])
+        
         for (index, object) in enumerate(input['objects'].values()):
             if len(input['objects']) > 1:
                 output['objects']['%(name)s-%(index)d' % locals()] = object
@@ -212,6 +323,6 @@ def merge(file, names, config, coord):
                 output['objects'][name] = object
             
             for geometry in object['geometries']:
-                update_arc_indexes(geometry, output['arcs'], input['arcs'])
+                shift_arc_indexes(geometry, offset)
     
-    file.write(json.dumps(output, separators=(',', ':')).encode('utf8'))
+    file.write(dumps(output))
@@ -0,0 +1,190 @@
+''' Conversion of TWKB geometries to WKB.
+
+PostGIS ST_AsTWKB() writes "tiny" well-known binary, with coordinates rounded
+to a given number of decimal digits then delta- and varint-encoded. Points at
+tile precision take two to four bytes instead of sixteen, so TWKB is cheaper
+to send from the database than WKB.
+
+Use to_wkb() to convert TWKB to little-endian 2D WKB, as expected by the
+VecTiles encoders. Z and M values are read and dropped.
+
+See also:
+    https://github.com/TWKB/Specification/blob/master/twkb.md
+'''
+
+from struct import pack, Struct
+
+from .wkb import (wkbNDR, wkbPoint, wkbLineString, wkbPolygon, wkbMultiPoint,
+                  wkbMultiLineString, wkbMultiPolygon, wkbGeometryCollection)
+
+#
+# TWKB metadata header flags
+#
+twkbBBox = 0x01
+twkbSize = 0x02
+twkbIdList = 0x04
+twkbExtendedDims = 0x08
+twkbEmpty = 0x10
+
+_header = Struct('<BI')
+_count = Struct('<I')
+_nan_point = pack('<dd', float('nan'), float('nan'))
+
+def read_varint(twkb, offset):
+    ''' Read an unsigned varint at an offset, return it and the next offset.
+    '''
+    value, shift = 0, 0
+
+    while True:
+        byte = twkb[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+
+        if byte < 0x80:
+            return value, offset
+
+        shift += 7
+
+def read_signed(twkb, offset):
+    ''' Read a zigzag-encoded signed varint, return it and the next offset.
+    '''
+    value, offset = read_varint(twkb, offset)
+    return (value >> 1) ^ -(value & 1), offset
+
+class Reader:
+    ''' Position and running coordinate state while reading one TWKB geometry.
+
+        Coordinates are delta-encoded from one point to the next across all
+        the parts of a geometry, so the previous point is carried along here.
+    '''
+    def __init__(self, twkb, offset, ndims, precision, has_ids):
+        self.twkb = twkb
+        self.offset = offset
+        self.ndims = ndims
+        self.divisor = 10. ** precision
+        self.has_ids = has_ids
+        self.x, self.y = 0, 0
+
+    def points(self, out):
+        ''' Append a count and that many points to a WKB bytearray.
+        '''
+        count, self.offset = read_varint(self.twkb, self.offset)
+        out += _count.pack(count)
+        self.read_points(out, count)
+
+    def read_points(self, out, count):
+        ''' Append count points without a leading count to a WKB bytearray.
+        '''
+        twkb, offset, divisor = self.twkb, self.offset, self.divisor
+        x, y = self.x, self.y
+        values = []
+
+        for i in range(count):
+            dx, offset = read_signed(twkb, offset)
+            dy, offset = read_signed(twkb, offset)
+
+            for j in range(self.ndims - 2):
+                # skip Z and M
+                _, offset = read_signed(twkb, offset)
+
+            x, y = x + dx, y + dy
+            values += (x / divisor, y / divisor)
+
+        out += pack('<%dd' % len(values), *values)
+        self.offset, self.x, self.y = offset, x, y
+
+    def rings(self, out):
+        ''' Append a count and that many rings to a WKB bytearray.
+        '''
+        count, self.offset = read_varint(self.twkb, self.offset)
+        out += _count.pack(count)
+
+        for i in range(count):
+            self.points(out)
+
+def write_point(reader, out):
+    reader.read_points(out, 1)
+
+def write_line(reader, out):
+    reader.points(out)
+
+def write_polygon(reader, out):
+    reader.rings(out)
+
+def write_multi(part_type, write_part):
+    ''' Make a writer for multi-geometries with parts of a single type.
+    '''
+    def write(reader, out):
+        count, reader.offset = read_varint(reader.twkb, reader.offset)
+        out += _count.pack(count)
+
+        if reader.has_ids:
+            for i in range(count):
+                _, reader.offset = read_signed(reader.twkb, reader.offset)
+
+        for i in range(count):
+            out += _header.pack(wkbNDR, part_type)
+            write_part(reader, out)
+
+    return write
+
+def write_collection(reader, out):
+    count, reader.offset = read_varint(reader.twkb, reader.offset)
+    out += _count.pack(count)
+
+    if reader.has_ids:
+        for i in range(count):
+            _, reader.offset = read_signed(reader.twkb, reader.offset)
+
+    for i in range(count):
+        # each member is a complete TWKB geometry with its own header.
+        reader.offset = write_geometry(reader.twkb, reader.offset, out)
+
+writers = {wkbPoint: write_point, wkbLineString: write_line, wkbPolygon: write_polygon,
+           wkbMultiPoint: write_multi(wkbPoint, write_point),
+           wkbMultiLineString: write_multi(wkbLineString, write_line),
+           wkbMultiPolygon: write_multi(wkbPolygon, write_polygon),
+           wkbGeometryCollection: write_collection}
+
+def write_geometry(twkb, offset, out):
+    ''' Append WKB for the TWKB geometry at an offset, return the next offset.
+    '''
+    type_precision, flags = twkb[offset], twkb[offset + 1]
+    offset += 2
+
+    geom_type = type_precision & 0x0f
+    precision = (type_precision >> 4 >> 1) ^ -(type_precision >> 4 & 1)
+    ndims = 2
+
+    if geom_type not in writers:
+        raise ValueError('Unknown TWKB geometry type %d' % geom_type)
+
+    if flags & twkbExtendedDims:
+        ndims += bool(twkb[offset] & 0x01) + bool(twkb[offset] & 0x02)
+        offset += 1
+
+    if flags & twkbSize:
+        _, offset = read_varint(twkb, offset)
+
+    out += _header.pack(wkbNDR, geom_type)
+
+    if flags & twkbEmpty:
+        # empty points have NaN coordinates in WKB, everything else a zero count.
+        out += _nan_point if geom_type == wkbPoint else _count.pack(0)
+        return offset
+
+    if flags & twkbBBox:
+        for i in range(2 * ndims):
+            _, offset = read_signed(twkb, offset)
+
+    reader = Reader(twkb, offset, ndims, precision, bool(flags & twkbIdList))
+    writers[geom_type](reader, out)
+
+    return reader.offset
+
+def to_wkb(twkb):
+    ''' Convert a bytes-like TWKB geometry to little-endian 2D WKB bytes.
+    '''
+    out = bytearray()
+    write_geometry(bytearray(twkb), 0, out)
+    return bytes(out)
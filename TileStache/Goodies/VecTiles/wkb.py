@@ -8,13 +8,21 @@ spherical mercator zoom 18 street scale geography.
 
 Reduced-precision WKB geometries will compress as much as 50% smaller with zlib.
 
+Use geo_interface() to read a WKB geometry straight into a GeoJSON-like
+dictionary, without building an intermediate shapely geometry.
+
 See also:
     http://edndoc.esri.com/arcsde/9.0/general_topics/wkb_representation.htm
     http://en.wikipedia.org/wiki/Double-precision_floating-point_format
 '''
 
-from struct import unpack
-from io import BytesIO
+from struct import unpack_from
+
+try:
+    import numpy
+except ImportError:
+    # numpy is optional, approx_points() nulls one double at a time without it.
+    numpy = None
 
 #
 # wkbByteOrder
@@ -35,114 +43,197 @@ wkbGeometryCollection = 7
 
 wkbMultis = wkbMultiPoint, wkbMultiLineString, wkbMultiPolygon, wkbGeometryCollection
 
-def copy_byte(src, dest):
-    ''' Copy an unsigned byte between files, and return it.
+wkbNames = {wkbPoint: 'Point', wkbLineString: 'LineString', wkbPolygon: 'Polygon',
+            wkbMultiPoint: 'MultiPoint', wkbMultiLineString: 'MultiLineString',
+            wkbMultiPolygon: 'MultiPolygon', wkbGeometryCollection: 'GeometryCollection'}
+
+def approx_points(wkb, offset, count, low):
+    ''' Null the least-significant bytes of count points at an offset, in-place.
+    
+        Low is the slice of the three least-significant bytes in each double.
     '''
-    byte = src.read(1)
-    dest.write(byte)
+    if numpy is not None:
+        doubles = numpy.frombuffer(wkb, numpy.uint8, 16 * count, offset)
+        doubles.reshape(2 * count, 8)[:, low] = 0
+        return
+    
+    for start in range(offset, offset + 16 * count, 8):
+        wkb[start + low.start:start + low.stop] = b'\x00\x00\x00'
 
-    (val, ) = unpack('B', byte)
-    return val
+def approx_line(wkb, offset, order, low):
+    ''' Approximate a counted list of points in-place, return the next offset.
+    '''
+    (points, ) = unpack_from(order + 'I', wkb, offset)
+    approx_points(wkb, offset + 4, points, low)
+    
+    return offset + 4 + 16 * points
 
-def copy_int_little(src, dest):
-    ''' Copy a little-endian unsigned 4-byte int between files, and return it.
+def approx_polygon(wkb, offset, order, low):
+    ''' Approximate a counted list of rings in-place, return the next offset.
     '''
-    word = src.read(4)
-    dest.write(word)
+    (rings, ) = unpack_from(order + 'I', wkb, offset)
+    offset += 4
     
-    (val, ) = unpack('<I', word)
-    return val
+    for i in range(rings):
+        offset = approx_line(wkb, offset, order, low)
+    
+    return offset
 
-def copy_int_big(src, dest):
-    ''' Copy a big-endian unsigned 4-byte int between files, and return it.
+def approx_point(wkb, offset, order, low):
+    ''' Approximate a single point in-place, return the next offset.
     '''
-    word = src.read(4)
-    dest.write(word)
+    approx_points(wkb, offset, 1, low)
     
-    (val, ) = unpack('>I', word)
-    return val
+    return offset + 16
 
-def approx_point_little(src, dest):
-    ''' Copy a pair of little-endian doubles between files, truncating significands.
+def approx_parts(wkb, offset, order, low):
+    ''' Approximate a counted list of geometries in-place, return the next offset.
     '''
-    xy = src.read(2 * 8)
-    dest.write('\x00\x00\x00')
-    dest.write(xy[-13:-8])
-    dest.write('\x00\x00\x00')
-    dest.write(xy[-5:])
-
-def approx_point_big(src, dest):
-    ''' Copy a pair of big-endian doubles between files, truncating significands.
+    (parts, ) = unpack_from(order + 'I', wkb, offset)
+    offset += 4
+    
+    for i in range(parts):
+        offset = approx_geometry(wkb, offset)
+    
+    return offset
+
+def approx_geometry(wkb, offset):
+    ''' Approximate a geometry at an offset in-place, return the next offset.
     '''
-    xy = src.read(2 * 8)
-    dest.write(xy[:5])
-    dest.write('\x00\x00\x00')
-    dest.write(xy[8:13])
-    dest.write('\x00\x00\x00')
+    (end, ) = unpack_from('B', wkb, offset)
+    
+    if end not in byte_orders:
+        raise ValueError(end)
+    
+    order, low = byte_orders[end]
+    (type, ) = unpack_from(order + 'I', wkb, offset + 1)
+    
+    if type not in approximators:
+        raise ValueError(type)
+    
+    return approximators[type](wkb, offset + 5, order, low)
 
-def approx_line(src, dest, copy_int, approx_point):
+def approximate_wkb(wkb_in):
+    ''' Return an approximation of the input WKB with lower-precision geometry.
+    
+        Coordinates are approximated in-place on one copy of the input,
+        whole point lists at a time when numpy is available.
     '''
+    wkb_out = bytearray(wkb_in)
+    offset = approx_geometry(wkb_out, 0)
+
+    assert len(wkb_in) == offset, 'The whole WKB was not processed'
+    
+    return bytes(wkb_out)
+
+def is_empty(wkb):
+    ''' Return true if the WKB is an empty geometry, with no coordinates at all.
+    
+        Covers empty collections, lines and polygons with a zero count, and
+        empty points written with NaN coordinates.
     '''
-    points = copy_int(src, dest)
+    if len(wkb) == 9:
+        return True
     
-    for i in range(points):
-        approx_point(src, dest)
+    if len(wkb) == 21:
+        order = '<' if wkb[0:1] == b'\x01' else '>'
+        (type, x) = unpack_from(order + 'Id', wkb, 1)
+        return type == wkbPoint and x != x
+    
+    return False
 
-def approx_polygon(src, dest, copy_int, approx_point):
+def read_point(wkb, offset, order):
+    ''' Read a single (x, y) point, return it and the next offset.
     '''
+    return unpack_from(order + 'dd', wkb, offset), offset + 16
+
+def read_points(wkb, offset, order):
+    ''' Read a counted list of (x, y) points, return it and the next offset.
     '''
-    rings = copy_int(src, dest)
+    (count, ) = unpack_from(order + 'I', wkb, offset)
+    values = unpack_from('%s%dd' % (order, count * 2), wkb, offset + 4)
     
-    for i in range(rings):
-        approx_line(src, dest, copy_int, approx_point)
+    return list(zip(values[0::2], values[1::2])), offset + 4 + 16 * count
 
-def approx_geometry(src, dest):
+def read_rings(wkb, offset, order):
+    ''' Read a counted list of point lists, return it and the next offset.
     '''
+    (count, ) = unpack_from(order + 'I', wkb, offset)
+    rings, offset = [], offset + 4
+    
+    for i in range(count):
+        ring, offset = read_points(wkb, offset, order)
+        rings.append(ring)
+    
+    return rings, offset
+
+def read_parts(wkb, offset, order):
+    ''' Read a counted list of geometry dictionaries, return it and the next offset.
     '''
-    end = copy_byte(src, dest)
+    (count, ) = unpack_from(order + 'I', wkb, offset)
+    parts, offset = [], offset + 4
     
-    if end == wkbNDR:
-        copy_int = copy_int_little
-        approx_point = approx_point_little
+    for i in range(count):
+        part, offset = read_geometry(wkb, offset)
+        parts.append(part)
     
-    elif end == wkbXDR:
-        copy_int = copy_int_big
-        approx_point = approx_point_big
+    return parts, offset
+
+def read_multi(wkb, offset, order):
+    ''' Read the coordinates of a counted list of parts, return them and the next offset.
+    '''
+    parts, offset = read_parts(wkb, offset, order)
+    
+    return [part['coordinates'] for part in parts], offset
+
+def read_geometry(wkb, offset):
+    ''' Read a geometry dictionary at an offset, return it and the next offset.
+    '''
+    (end, ) = unpack_from('B', wkb, offset)
     
-    else:
+    if end not in byte_orders:
         raise ValueError(end)
     
-    type = copy_int(src, dest)
-    
-    if type == wkbPoint:
-        approx_point(src, dest)
-            
-    elif type == wkbLineString:
-        approx_line(src, dest, copy_int, approx_point)
-            
-    elif type == wkbPolygon:
-        approx_polygon(src, dest, copy_int, approx_point)
-            
-    elif type in wkbMultis:
-        parts = copy_int(src, dest)
-        
-        for i in range(parts):
-            approx_geometry(src, dest)
-            
-    else:
+    order, low = byte_orders[end]
+    (type, ) = unpack_from(order + 'I', wkb, offset + 1)
+    
+    if type not in readers:
         raise ValueError(type)
+    
+    coordinates, offset = readers[type](wkb, offset + 5, order)
+    
+    if type == wkbGeometryCollection:
+        return dict(type='GeometryCollection', geometries=coordinates), offset
+    
+    return dict(type=wkbNames[type], coordinates=coordinates), offset
 
-def approximate_wkb(wkb_in):
-    ''' Return an approximation of the input WKB with lower-precision geometry.
+#
+# Byte order formats and least-significant double bytes, keyed on wkbByteOrder.
+#
+byte_orders = {wkbNDR: ('<', slice(0, 3)), wkbXDR: ('>', slice(5, 8))}
+
+#
+# Per-type handlers, keyed on wkbGeometryType.
+#
+approximators = {wkbPoint: approx_point, wkbLineString: approx_line, wkbPolygon: approx_polygon,
+                 wkbMultiPoint: approx_parts, wkbMultiLineString: approx_parts,
+                 wkbMultiPolygon: approx_parts, wkbGeometryCollection: approx_parts}
+
+readers = {wkbPoint: read_point, wkbLineString: read_points, wkbPolygon: read_rings,
+           wkbMultiPoint: read_multi, wkbMultiLineString: read_multi,
+           wkbMultiPolygon: read_multi, wkbGeometryCollection: read_parts}
+
+def geo_interface(wkb):
+    ''' Return a GeoJSON-like geometry dictionary for a 2D WKB geometry.
+    
+        Raises ValueError for geometry types other than the seven 2D ones,
+        e.g. WKB with Z or M dimensions or PostGIS EWKB with an SRID.
     '''
-    input, output = BytesIO(wkb_in), BytesIO()
-    approx_geometry(input, output)
-    wkb_out = output.getvalue()
+    geometry, offset = read_geometry(wkb, 0)
 
-    assert len(wkb_in) == input.tell(), 'The whole WKB was not processed'
-    assert len(wkb_in) == len(wkb_out), 'The output WKB is the wrong length'
+    assert len(wkb) == offset, 'The whole WKB was not processed'
     
-    return wkb_out
+    return geometry
 
 if __name__ == '__main__':
 
@@ -0,0 +1,882 @@
+from __future__ import print_function
+
+from unittest import TestCase
+from io import BytesIO
+from binascii import b2a_base64
+from time import sleep
+from threading import active_count
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:
+    # Python 2
+    from inspect import getargspec
+from decimal import Decimal
+from datetime import datetime
+import json
+
+from shapely.geometry import Point, LineString, Polygon, MultiPoint, MultiLineString, MultiPolygon, GeometryCollection
+from shapely.wkb import loads, dumps
+from shapely import wkt
+from ModestMaps.Core import Coordinate, Point as MMPoint
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from TileStache.Goodies.VecTiles import geojson, topojson, ops, twkb, server, mvt, wkb, sublayers
+from TileStache.Core import KnownUnknown
+
+# These tests exercise the VecTiles encoders and helpers directly,
+# and need no database.
+
+class GeoJSONDecodeTest(TestCase):
+    '''Decoding GeoJSON tiles back into WKB features'''
+
+    def test_decode_point(self):
+        body = json.dumps({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'name': 'Oakland'},
+             'geometry': {'type': 'Point', 'coordinates': [-122.27, 37.8]}}
+            ]})
+
+        features = geojson.decode(BytesIO(body.encode('utf8')))
+
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0][1], {'name': 'Oakland'})
+
+        # decoded geometries are projected to spherical mercator.
+        point = loads(features[0][0])
+        self.assertAlmostEqual(point.x, -13611034.14, 1)
+        self.assertAlmostEqual(point.y, 4551210.92, 1)
+
+    def test_decode_elevation(self):
+        body = json.dumps({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {},
+             'geometry': {'type': 'LineString', 'coordinates': [[0, 0, 100], [1, 0, 200]]}}
+            ]})
+
+        line = loads(geojson.decode(BytesIO(body.encode('utf8')))[0][0])
+
+        # elevations are dropped rather than mixed into x and y.
+        self.assertEqual(len(line.coords), 2)
+        self.assertAlmostEqual(line.coords[0][0], 0)
+        self.assertAlmostEqual(line.coords[0][1], 0)
+        self.assertAlmostEqual(line.coords[1][0], 111319.49, 2)
+        self.assertAlmostEqual(line.coords[1][1], 0)
+
+    def test_decode_cache(self):
+        def body(name):
+            return BytesIO(json.dumps({'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'properties': {'name': name},
+                 'geometry': {'type': 'Point', 'coordinates': [0, 0]}}
+                ]}).encode('utf8'))
+
+        geojson._decoded_features.clear()
+        features = geojson.decode(body('one'))
+        features[0][1]['name'] = 'changed'
+
+        # changes to one result don't show up in the next.
+        self.assertEqual(geojson.decode(body('one'))[0][1], {'name': 'one'})
+
+        # a tile used again moves to the end, and the least recently used is dropped.
+        maximum = geojson._decoded_features_max
+
+        for index in range(maximum - 1):
+            geojson.decode(body(str(index)))
+
+        geojson.decode(body('one'))
+        geojson.decode(body('new'))
+
+        self.assertEqual(len(geojson._decoded_features), maximum)
+        self.assertEqual(list(geojson._decoded_features.values())[-2][0][1], {'name': 'one'})
+        names = [features[0][1]['name'] for features in geojson._decoded_features.values()]
+        self.assertFalse('0' in names)
+
+class GeoJSONEncodeTest(TestCase):
+    '''Encoding features into GeoJSON tiles'''
+
+    def test_encode_precision(self):
+        out = BytesIO()
+        geojson.encode(out, [(Point(1.23456789, 2).wkb, {'height': 12.3456789, 'levels': 3, 'name': u'Z\xfcrich'}, 7)], 10, False)
+
+        # floats in properties are truncated like coordinates, whatever JSON libraries are installed.
+        self.assertEqual(out.getvalue(), b'{"type":"FeatureCollection","features":[{"type":"Feature",'
+                                         b'"properties":{"height":12.34568,"levels":3,"name":"Z\\u00fcrich"},'
+                                         b'"geometry":{"type":"Point","coordinates":[1.23457,2.00000]},"id":7}]}')
+
+class GeoJSONMergeTest(TestCase):
+    '''Merging GeoJSON sub-layer tiles'''
+
+    def setUp(self):
+        self.getTile = sublayers.getTile
+        self.json = geojson.json
+        geojson.json = CountingJSON()
+
+    def tearDown(self):
+        sublayers.getTile = self.getTile
+        geojson.json = self.json
+
+    def merge(self, bodies):
+        sublayers.getTile = lambda layer, coord, extension: ('application/json', bodies[layer])
+        config = FakeConfig('.')
+        config.layers = dict([(name, name) for name in bodies])
+
+        out = BytesIO()
+        geojson.merge(out, sorted(bodies), config, Coordinate(0, 0, 0))
+        return out.getvalue()
+
+    def test_merge(self):
+        water, land = BytesIO(), BytesIO()
+        geojson.encode(water, [(Point(1, 2).wkb, {'kind': 'lake'})], 10, False)
+        geojson.encode(land, [], 10, False)
+
+        merged = self.merge({'water': water.getvalue(), 'land': land.getvalue()})
+
+        # bodies from encode() are checked and spliced in without parsing.
+        self.assertEqual(geojson.json.parsed, 0)
+        self.assertEqual(json.loads(merged.decode('utf8')),
+                         {'water': json.loads(water.getvalue().decode('utf8')),
+                          'land': {'type': 'FeatureCollection', 'features': []}})
+
+    def test_merge_other_bodies(self):
+        body = b'{"features": [], "type": "FeatureCollection"}'
+        merged = self.merge({'other': body})
+
+        self.assertEqual(geojson.json.parsed, 1)
+        self.assertEqual(json.loads(merged.decode('utf8')), {'other': json.loads(body.decode('utf8'))})
+
+        body = b'{"type": "Feature", "properties": {}, "geometry": null}'
+        self.assertRaises(KnownUnknown, self.merge, {'other': body})
+
+class SubLayersTest(TestCase):
+    '''Loading sub-layer tiles for merged responses'''
+
+    def setUp(self):
+        self.getTile = sublayers.getTile
+
+    def tearDown(self):
+        sublayers.getTile = self.getTile
+
+    def test_load_tiles(self):
+        loading, most = [], []
+
+        def getTile(layer, coord, extension):
+            loading.append(layer)
+            most.append(len(loading))
+            sleep(.05)
+            loading.remove(layer)
+
+            if layer == 'bad':
+                raise KnownUnknown(layer)
+
+            return 'application/json', layer.encode('utf8')
+
+        sublayers.getTile = getTile
+        layers = ['a', 'b', 'c', 'd', 'e']
+
+        # responses come back in layer order, from one thread per layer by default.
+        self.assertEqual(sublayers.load_tiles(layers, None, 'json'),
+                         [('application/json', layer.encode('utf8')) for layer in layers])
+        self.assertEqual(max(most), 5)
+
+        del most[:]
+        sublayers.load_tiles(layers, None, 'json', 2)
+        self.assertTrue(max(most) <= 2)
+
+        self.assertRaises(KnownUnknown, sublayers.load_tiles, ['a', 'bad', 'c'], None, 'json')
+
+class CountingJSON:
+    ''' Stand-in for the json module that counts calls to loads().
+    '''
+    def __init__(self):
+        self.parsed = 0
+
+    def loads(self, *args, **kwargs):
+        self.parsed += 1
+        return json.loads(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(json, name)
+
+class WKBTest(TestCase):
+    '''Reading and approximating WKB without shapely'''
+
+    def setUp(self):
+        self.shapes = [
+            Point(1.5, -2.25),
+            LineString([(0, 0), (1, 1), (2, 0)]),
+            Polygon([(0, 0), (4, 0), (4, 4), (0, 0)], [[(1, 1), (2, 1), (2, 2), (1, 1)]]),
+            MultiPoint([(1, 2), (3, 4)]),
+            MultiLineString([[(0, 1), (1, 0)], [(2, 2), (3, 3)]]),
+            MultiPolygon([Point(0, 0).buffer(1, 1), Point(5, 5).buffer(1, 1)]),
+            wkt.loads('GEOMETRYCOLLECTION (POINT (1 2), LINESTRING (0 0, 3 3))')
+            ]
+
+    def test_geo_interface(self):
+        for shape in self.shapes:
+            for big_endian in (False, True):
+                geometry = wkb.geo_interface(dumps(shape, big_endian=big_endian))
+
+                self.assertEqual(geometry['type'], shape.geom_type)
+                self.assertTrue(geojson.asShape(geometry).equals_exact(shape, 0), shape.wkt)
+
+        # Z dimensions and bad byte orders are refused, to be read by shapely instead.
+        self.assertRaises(ValueError, wkb.geo_interface, LineString([(0, 0, 1), (1, 1, 2)]).wkb)
+        self.assertRaises(ValueError, wkb.geo_interface, b'\x02' + Point(1, 2).wkb[1:])
+
+    def test_is_empty(self):
+        self.assertTrue(wkb.is_empty(GeometryCollection().wkb))
+        self.assertTrue(wkb.is_empty(LineString().wkb))
+        self.assertTrue(wkb.is_empty(b'\x01\x01\x00\x00\x00' + b'\x00\x00\x00\x00\x00\x00\xf8\x7f' * 2))
+        self.assertTrue(wkb.is_empty(b'\x00\x00\x00\x00\x01' + b'\x7f\xf8\x00\x00\x00\x00\x00\x00' * 2))
+
+        self.assertFalse(wkb.is_empty(Point(0, 0).wkb))
+        self.assertFalse(wkb.is_empty(LineString([(0, 0), (1, 1)]).wkb))
+
+    def test_approximate_wkb(self):
+        numpy = wkb.numpy
+
+        for shape in self.shapes:
+            for big_endian in (False, True):
+                data = dumps(shape, big_endian=big_endian)
+                approximated = wkb.approximate_wkb(data)
+
+                # same geometry, within 26 bits of precision.
+                self.assertEqual(len(approximated), len(data))
+                self.assertTrue(loads(approximated).equals_exact(shape, 1e-6), shape.wkt)
+
+                # with and without numpy, the same bytes are nulled.
+                wkb.numpy = None
+
+                try:
+                    self.assertEqual(wkb.approximate_wkb(data), approximated)
+                finally:
+                    wkb.numpy = numpy
+
+        # least significant bytes come first in little-endian doubles.
+        approximated = wkb.approximate_wkb(Point(0.1, 0.2).wkb)
+        self.assertEqual(approximated[5:8], b'\x00\x00\x00')
+        self.assertEqual(approximated[13:16], b'\x00\x00\x00')
+
+class MVTTest(TestCase):
+    '''Encoding and decoding MVT tiles'''
+
+    def test_round_trip(self):
+        features = [(Point(-13611034.14, 4551210.92).wkb, {'name': 'Oakland', 'rank': 2}),
+                    (LineString([(0, 0), (1e6, 1e6)]).wkb, {}),
+                    (memoryview(Point(1, 2).buffer(1, 1).wkb), {'area': 3.14})]
+
+        out = BytesIO()
+        mvt.encode(out, features)
+        body = out.getvalue()
+
+        self.assertEqual(body[:4], b'\x89MVT')
+        decoded = mvt.decode(BytesIO(body))
+
+        self.assertEqual([props for (data, props) in decoded], [props for (data, props) in features])
+
+        # mercator meters are approximated to a few centimeters.
+        for ((data, props), (original, props)) in zip(decoded, features):
+            self.assertTrue(loads(bytes(data)).equals_exact(loads(bytes(original)), .1))
+
+    def test_round_trip_chunks(self):
+        # enough features for several compress() calls.
+        features = [(Point(i, -i).wkb, {'id': i}) for i in range(5000)]
+
+        out = BytesIO()
+        mvt.encode(out, features)
+        decoded = mvt.decode(BytesIO(out.getvalue()))
+
+        self.assertEqual(len(decoded), 5000)
+        self.assertEqual(decoded[4999][1], {'id': 4999})
+        self.assertTrue(loads(bytes(decoded[4999][0])).equals(Point(4999, -4999)))
+
+    def test_bad_head(self):
+        self.assertRaises(Exception, mvt.decode, BytesIO(b'\x89TJV\x00\x00\x00\x00'))
+
+class OpsTest(TestCase):
+    '''Flattening and transforming shapely geometries'''
+
+    def test_flatten_unflatten(self):
+        shapes = [Point(1, 2), LineString([(0, 0), (1, 1), (2, 0)]),
+                  Polygon([(0, 0), (3, 0), (3, 3), (0, 0)], [[(1, 1), (2, 1), (2, 2), (1, 1)]]),
+                  MultiPolygon([Polygon([(0, 0), (1, 0), (1, 1), (0, 0)]),
+                                Polygon([(5, 5), (6, 5), (6, 6), (5, 5)])]),
+                  MultiPoint([(0, 0), (1, 1)]), GeometryCollection()]
+
+        for shape in shapes:
+            coords, tree = ops.flatten(shape)
+            self.assertEqual(len(coords), len(get_coords(shape)))
+            self.assertTrue(ops.unflatten(coords, tree).equals(shape))
+
+    def test_transform_coords(self):
+        shape = Polygon([(0, 0), (3, 0), (3, 3), (0, 0)], [[(1, 1), (2, 1), (2, 2), (1, 1)]])
+        moved = ops.transform_coords(shape, lambda xs, ys: ([x + 1 for x in xs], [y * 2 for y in ys]))
+
+        self.assertTrue(moved.equals(ops.transform(shape, lambda xy: (xy[0] + 1, xy[1] * 2))))
+
+    def test_transform_coords_3d(self):
+        line = LineString([(0, 1, 10), (2, 3, 20), (4, 5, 30)])
+        mixed = MultiLineString([[(0, 1), (2, 3)], [(4, 5, 10), (6, 7, 20)]])
+        identity = lambda xs, ys: (list(xs), list(ys))
+        numpy = ops.numpy
+
+        # with and without numpy, Z values are dropped and x and y stay paired.
+        for optional_numpy in (numpy, None):
+            ops.numpy = optional_numpy
+
+            try:
+                self.assertEqual(list(ops.transform_coords(line, identity).coords),
+                                 [(0, 1), (2, 3), (4, 5)])
+
+                self.assertEqual([list(part.coords) for part in ops.transform_coords(mixed, identity).geoms],
+                                 [[(0, 1), (2, 3)], [(4, 5), (6, 7)]])
+            finally:
+                ops.numpy = numpy
+
+class TopoJSONTest(TestCase):
+    '''Encoding TopoJSON tiles'''
+
+    def setUp(self):
+        circle = Point(0.5, 0.5).buffer(0.25, 16)
+
+        self.features = [
+            (Point(0.1, 0.2).wkb, {'kind': 'point'}),
+            (LineString([(0, 0), (0.5, 0.5), (1, 0)]).wkb, {'kind': 'line'}, 'line-1'),
+            (circle.difference(Point(0.5, 0.5).buffer(0.1, 2)).wkb, {'name': u'Z\xfcrich', 'area': 0.0001}),
+            (MultiPoint([(0.1, 0.1), (0.9, 0.9)]).wkb, {}),
+            (MultiLineString([[(0, 1), (1, 0)], [(0.2, 0.2), (0.2, 0.2), (0.3, 0.3)]]).wkb, {}),
+            (MultiPolygon([circle, Point(2, 2).buffer(0.5, 1)]).wkb, {}, 7),
+            (GeometryCollection().wkb, {})
+            ]
+
+    def encode(self, features, bounds=(0, 0, 1, 1)):
+        out = BytesIO()
+        topojson.encode(out, features, bounds, True)
+        return out.getvalue()
+
+    def test_encode_fallbacks(self):
+        optional = dict(from_wkb=topojson.from_wkb, numpy=topojson.numpy)
+
+        # a whole-world sized tile, and a high zoom one with exponents in its
+        # scale and numpy arcs many thousands of units long.
+        for bounds in [(0, 0, 1, 1), (0.4999, 0.4999, 0.5001, 0.5001)]:
+            expected = self.encode(self.features, bounds)
+
+            # without Shapely 2, and without numpy as well, the fast
+            # paths left give the same bytes as all of them together.
+            for names in [('from_wkb', ), ('from_wkb', 'numpy')]:
+                for name in names:
+                    setattr(topojson, name, None)
+
+                try:
+                    self.assertEqual(self.encode(self.features, bounds), expected, names)
+                finally:
+                    for (name, value) in optional.items():
+                        setattr(topojson, name, value)
+
+    def test_encode_json(self):
+        features = [(Point(0.5, 0.5).wkb, {'name': u'Z\xfcrich', 'height': 1e-05})]
+        out = BytesIO()
+        topojson.encode(out, features, (0, 0, 1e-4, 1e-4), False)
+        body = out.getvalue()
+
+        # escapes and floats are written by the standard library, whatever JSON libraries are installed.
+        self.assertEqual(body, json.dumps(json.loads(body.decode('utf8')), separators=(',', ':')).encode('utf8'))
+        self.assertTrue(b'"name":"Z\\u00fcrich"' in body)
+        self.assertTrue(b'"scale":[9.765625e-08,9.765625e-08]' in body)
+
+    def test_encode(self):
+        topo = json.loads(self.encode(self.features).decode('utf8'))
+        geometries = topo['objects']['vectile']['geometries']
+        arcs = [topojson_dediff(arc) for arc in topo['arcs']]
+
+        self.assertEqual([g['type'] for g in geometries],
+                         ['Point', 'LineString', 'Polygon', 'MultiPoint', 'MultiLineString', 'MultiPolygon'])
+        self.assertEqual(topo['transform'], {'translate': [0, 0], 'scale': [1./1024, 1./1024]})
+        self.assertEqual(geometries[0]['coordinates'], [102, 205])
+        self.assertEqual(geometries[1]['id'], 'line-1')
+        self.assertEqual(geometries[5]['id'], 7)
+        self.assertEqual(geometries[3]['coordinates'], [[102, 102], [922, 922]])
+
+        # arcs are numbered in order, and repeated points are left out.
+        self.assertEqual(geometries[1]['arcs'], [0])
+        self.assertEqual(arcs[0], [[0, 0], [512, 512], [1024, 0]])
+        self.assertEqual(geometries[4]['arcs'], [[3], [4]])
+        self.assertEqual(arcs[4], [[205, 205], [307, 307]])
+        self.assertEqual(len(arcs), 7)
+
+    def test_shift_arc_indexes(self):
+        geometries = [dict(type='Point', coordinates=[1, 2]),
+                      dict(type='LineString', arcs=[0]),
+                      dict(type='Polygon', arcs=[[1], [-3]]),
+                      dict(type='MultiLineString', arcs=[[2], [-1]]),
+                      dict(type='MultiPolygon', arcs=[[[0], [~1]], [[4]]])]
+
+        for geometry in geometries:
+            topojson.shift_arc_indexes(geometry, 10)
+
+        # reversed arcs are one's complements, so they move the other way.
+        self.assertEqual([g.get('arcs') for g in geometries],
+                         [None, [10], [[11], [-13]], [[12], [-11]], [[[10], [~11]], [[14]]]])
+        self.assertEqual(geometries[0]['coordinates'], [1, 2])
+
+        self.assertRaises(NotImplementedError, topojson.shift_arc_indexes, dict(type='GeometryCollection'), 1)
+
+    def test_diff_encode(self):
+        transform, forward = topojson.get_transform((0, 0, 1, 1))
+        line = LineString([(0, 0), (0.5, 0.5), (0.5001, 0.5001), (1, 0)])
+
+        self.assertEqual(topojson.diff_encode(line, transform), [(0, 0), (512, 512), (512, -512)])
+
+        # long lines use numpy, with the same results.
+        line = Point(0.5, 0.5).buffer(0.25, 64).exterior
+        self.assertTrue(len(line.coords) >= topojson.numpy_min_points)
+
+        numpy = topojson.numpy
+        expected = topojson.diff_encode(line, transform)
+        topojson.numpy = None
+
+        try:
+            self.assertEqual([list(xy) for xy in topojson.diff_encode(line, transform)],
+                             [list(xy) for xy in expected])
+        finally:
+            topojson.numpy = numpy
+
+    def test_encode_arcs(self):
+        transform, forward = topojson.get_transform((0, 0, 1, 1))
+        lines = [LineString([(0, 0), (0.5, 0.5), (0.5001, 0.5001), (1, 0)]),
+                 Point(0.5, 0.5).buffer(0.25, 64).exterior,
+                 LineString([(0.2, 0.2), (0.2, 0.2)]),
+                 Polygon([(0, 0), (1, 0), (1, 1), (0, 0)]).exterior]
+
+        # arcs of a whole tile match those of one line at a time.
+        self.assertEqual([[list(xy) for xy in arc] for arc in topojson.encode_arcs(lines, transform)],
+                         [[list(xy) for xy in topojson.diff_encode(line, transform)] for line in lines])
+        self.assertEqual(topojson.encode_arcs([], transform), [])
+
+class TWKBTest(TestCase):
+    '''Converting TWKB geometries to WKB'''
+
+    def assertConverts(self, data, expected):
+        shape = loads(twkb.to_wkb(data))
+        self.assertEqual(shape.geom_type, expected.geom_type)
+        self.assertFalse(shape.has_z)
+        self.assertTrue(shape.equals_exact(expected, 1e-9), shape.wkt)
+
+    def test_point(self):
+        # type 1, precision 0
+        self.assertConverts(b'\x01\x00' + signed(1, 2), Point(1, 2))
+
+        # precision 2, with a bounding box and a size
+        body = signed(125, 250)
+        data = b'\x41\x03' + varint(len(body) + 4) + signed(125, 0, 250, 0) + body
+        self.assertConverts(data, Point(1.25, 2.5))
+
+    def test_negative_precision(self):
+        # precision -1, values are in tens
+        self.assertConverts(b'\x11\x00' + signed(12, -3), Point(120, -30))
+
+    def test_line(self):
+        data = b'\x02\x00' + varint(3) + signed(0, 0, 10, 10, -5, 20)
+        self.assertConverts(data, LineString([(0, 0), (10, 10), (5, 30)]))
+
+    def test_polygon(self):
+        # one square ring, deltas carry on from ring to ring
+        ring = signed(0, 0, 4, 0, 0, 4, -4, 0, 0, -4)
+        hole = signed(1, 1, 1, 0, 0, 1, -1, 0, 0, -1)
+        data = b'\x03\x00' + varint(2) + varint(5) + ring + varint(5) + hole
+        expected = Polygon([(0, 0), (4, 0), (4, 4), (0, 4), (0, 0)],
+                           [[(1, 1), (2, 1), (2, 2), (1, 2), (1, 1)]])
+        self.assertConverts(data, expected)
+
+    def test_multi_with_ids(self):
+        # ID list flag, two IDs come before the parts
+        data = b'\x04\x04' + varint(2) + signed(10, 20) + signed(1, 2, 2, 2)
+        self.assertConverts(data, MultiPoint([(1, 2), (3, 4)]))
+
+        data = b'\x05\x04' + varint(2) + signed(-1, 7) \
+             + varint(2) + signed(0, 0, 1, 1) + varint(2) + signed(4, 4, 1, -1)
+        self.assertConverts(data, MultiLineString([[(0, 0), (1, 1)], [(5, 5), (6, 4)]]))
+
+    def test_collection(self):
+        data = b'\x07\x00' + varint(2) + b'\x01\x00' + signed(1, 2) \
+             + b'\x02\x00' + varint(2) + signed(0, 0, 3, 3)
+        self.assertConverts(data, wkt.loads('GEOMETRYCOLLECTION (POINT (1 2), LINESTRING (0 0, 3 3))'))
+
+    def test_z_dropped(self):
+        # extended dimensions byte with Z, precision 0
+        data = b'\x02\x08\x01' + varint(2) + signed(0, 0, 9, 1, 1, 9)
+        self.assertConverts(data, LineString([(0, 0), (1, 1)]))
+
+    def test_empty(self):
+        for (data, geom_type) in [(b'\x01\x10', 'Point'), (b'\x02\x10', 'LineString'),
+                                  (b'\x03\x10', 'Polygon'), (b'\x06\x10', 'MultiPolygon')]:
+            shape = loads(twkb.to_wkb(data))
+            self.assertEqual(shape.geom_type, geom_type)
+            self.assertTrue(shape.is_empty)
+
+class ServerTest(TestCase):
+    '''Reading PostGIS rows and building queries'''
+
+    def test_twkb_precision(self):
+        # pre-scaled queries are in whole pixels.
+        self.assertEqual(server.twkb_precision(True, 256, 10), 0)
+        self.assertEqual(server.twkb_precision(False, 4096, 10), 0)
+
+        # degrees follow the GeoJSON precisions, mercator meters get coarser when zoomed out.
+        self.assertEqual([server.twkb_precision(True, None, z) for z in (0, 10, 16, 30)], [2, 5, 6, 7])
+        self.assertEqual([server.twkb_precision(False, None, z) for z in (0, 10, 16, 30)], [-4, -1, 1, 5])
+
+    def test_build_query_template(self):
+        subquery = 'SELECT name, way AS __geometry__ FROM roads WHERE way && !bbox!'
+        query = server.build_query_template(900913, subquery, ['name', '__geometry__'], 2.0, True, True, None,
+                                            True, True, 'dp', 5, 'md5', True)
+        bbox = 'ST_SetSRID(!bbox!, 900913)'
+
+        self.assertTrue(query.startswith('SELECT q."name", Substr(MD5(ST_AsBinary(q.__geometry__)), 1, 10) AS __id__,'))
+        self.assertTrue("encode(ST_AsTWKB(ST_Transform(ST_Simplify(CASE WHEN q.__geometry__ @ %s THEN ST_MakeValid(q.__geometry__) "
+                        "ELSE ST_Intersection(ST_MakeValid(q.__geometry__), %s) END, 2.00), 4326), 5), 'base64') AS __geometry__"
+                        % (bbox, bbox) in query)
+        self.assertTrue('WHERE way && %s' % bbox in query)
+        self.assertTrue('AND ST_Intersects(q.__geometry__, %s)' % bbox in query)
+
+        query = server.build_query_template(4326, 'SELECT * FROM points', ['__id__', '__geometry__'], None, False, False, 256,
+                                            True, False, 'dp', None, 'md5', False)
+
+        self.assertTrue(query.startswith('SELECT q."__id__",'))
+        self.assertTrue("encode(ST_AsBinary(ST_TransScale(q.__geometry__, !transscale!)), 'base64') AS __geometry__" in query)
+
+        self.assertRaises(Exception, server.build_query_template, 4326, 'SELECT 1', ['__id__'], None, False, False, None,
+                          False, False, 'dp', None, 'md5', False)
+
+    def test_query_templates_bounded(self):
+        templates, maximum = dict(server._query_templates), server._query_templates_max
+        server._query_templates.clear()
+        server._query_templates_max = 4
+        bounds = (0, 0, 1, 1)
+
+        try:
+            for index in range(6):
+                server.build_query(900913, 'SELECT %d' % index, ['__geometry__'], bounds, None, False, True)
+
+            server.build_query(900913, 'SELECT 2', ['__geometry__'], bounds, None, False, True)
+            server.build_query(900913, 'SELECT 6', ['__geometry__'], bounds, None, False, True)
+
+            # the least recently used templates are dropped.
+            self.assertEqual([key[1] for key in server._query_templates],
+                             ['SELECT 4', 'SELECT 5', 'SELECT 2', 'SELECT 6'])
+        finally:
+            server._query_templates.clear()
+            server._query_templates.update(templates)
+            server._query_templates_max = maximum
+
+    def test_build_query_template_validate(self):
+        def geometry(is_clipped, validate_geometry):
+            query = server.build_query_template(900913, 'SELECT * FROM t', ['__geometry__'], None, False, is_clipped,
+                                                None, True, False, 'dp', None, 'md5', validate_geometry)
+            return query.split('encode(')[1].split(", 'base64')")[0]
+
+        bbox = 'ST_SetSRID(!bbox!, 900913)'
+
+        # contained and intersected geometries are both repaired, as are unclipped ones.
+        self.assertEqual(geometry(True, True), 'ST_AsBinary(CASE WHEN q.__geometry__ @ %s THEN ST_MakeValid(q.__geometry__) '
+                                               'ELSE ST_Intersection(ST_MakeValid(q.__geometry__), %s) END)' % (bbox, bbox))
+        self.assertEqual(geometry(False, True), 'ST_AsBinary(ST_MakeValid(q.__geometry__))')
+
+        self.assertEqual(geometry(True, False), 'ST_AsBinary(CASE WHEN q.__geometry__ @ %s THEN q.__geometry__ '
+                                                'ELSE ST_Intersection(q.__geometry__, %s) END)' % (bbox, bbox))
+        self.assertEqual(geometry(False, False), 'ST_AsBinary(q.__geometry__)')
+
+        for is_clipped in (True, False):
+            query = server.build_mvt_query_template(900913, 'SELECT * FROM t', ['__geometry__'], None, is_clipped,
+                                                    4096, 'layer', 'dp', True)
+            self.assertTrue('ST_AsMVTGeom(ST_MakeValid(q.__geometry__), ' in query)
+
+            query = server.build_mvt_query_template(900913, 'SELECT * FROM t', ['__geometry__'], None, is_clipped,
+                                                    4096, 'layer', 'dp', False)
+            self.assertFalse('ST_MakeValid' in query)
+
+    def test_build_query_template_intersects(self):
+        def query(is_clipped, strict_intersects):
+            return server.build_query_template(900913, 'SELECT * FROM t', ['__geometry__'], None, False, is_clipped,
+                                               None, True, strict_intersects, 'dp', None, 'md5', True)
+
+        # unclipped features that miss the tile are never emptied, so they're always tested.
+        self.assertTrue('ST_Intersects' in query(False, False))
+        self.assertTrue('ST_Intersects' in query(False, True))
+        self.assertTrue('ST_Intersects' in query(True, True))
+        self.assertFalse('ST_Intersects' in query(True, False))
+
+        # every entry point has the same default.
+        for function in (server.Provider.__init__, server.Response.__init__, server.build_query, server.build_prepared_query):
+            args = getargspec(function)
+            self.assertFalse(args.defaults[args.args.index('strict_intersects') - len(args.args)])
+
+    def test_read_union_features_twkb(self):
+        # query 0 selects WKB and query 1 selects TWKB.
+        rows = [(0, b2a_base64(Point(1, 2).wkb), {'__id__': ['20', '1'], 'name': ['25', 'a']}),
+                (1, b2a_base64(b'\x01\x00' + signed(3, 4)), {'__id__': ['20', '2'], 'name': ['25', None]})]
+
+        features = server.read_union_features(FakeCursor(rows), set([1]))
+
+        self.assertEqual([(index, id, props) for (index, (wkb, props, id)) in features],
+                         [(0, 1, {'name': 'a'}), (1, 2, {})])
+        self.assertTrue(loads(features[0][1][0]).equals(Point(1, 2)))
+        self.assertTrue(loads(features[1][1][0]).equals(Point(3, 4)))
+
+    def test_read_union_features_types(self):
+        # numeric, bigint, timestamp, text[] and text columns, as psycopg2 reads them in a plain query.
+        values = Decimal('1.50'), 12345678901, datetime(2020, 1, 2, 3, 4, 5), ['a', 'b'], u'Z\xfcrich'
+        texts = '1.50', '12345678901', '2020-01-02 03:04:05', '{a,b}', u'Z\xfcrich'
+        oids = '1700', '20', '1114', '1009', '25'
+        names = 'rank', 'population', 'updated', 'tags', 'name'
+
+        description = [('__id__', ), ('__geometry__', )] + [(name, ) for name in names]
+        row = ('abc', b2a_base64(Point(1, 2).wkb)) + values
+        expected = server.read_features(FakeCursor([row], description))
+
+        properties = dict([(name, [oid, text]) for (name, oid, text) in zip(names, oids, texts)])
+        properties['__id__'] = ['25', 'abc']
+        features = server.read_union_features(FakeCursor([(0, b2a_base64(Point(1, 2).wkb), properties)]))
+
+        # a layer has the same property types in a union as on its own.
+        self.assertEqual(features, [(0, expected[0])])
+        self.assertEqual(features[0][1][1], dict(zip(names, values)))
+        self.assertEqual([type(value) for value in features[0][1][1].values()],
+                         [type(value) for value in expected[0][1].values()])
+
+    def test_build_union_query(self):
+        query = server.build_union_query([('SELECT 1', set(['__geometry__', '__id__', 'name', 'area'])),
+                                          ('SELECT 2', set(['__geometry__', '__id__']))])
+
+        self.assertTrue('''SELECT row_to_json(p) FROM (SELECT ARRAY[pg_typeof(t."__id__")::oid::text, t."__id__"::text] AS "__id__", '''
+                        '''ARRAY[pg_typeof(t."area")::oid::text, t."area"::text] AS "area", '''
+                        '''ARRAY[pg_typeof(t."name")::oid::text, t."name"::text] AS "name") AS p''' in query)
+        self.assertTrue('SELECT 1 AS __layer__' in query.split('UNION ALL')[1])
+
+    def test_read_features_twkb(self):
+        description = [('__id__', ), ('__geometry__', ), ('name', )]
+        rows = [(7, b2a_base64(b'\x01\x00' + signed(3, 4)), 'b')]
+
+        features = server.read_features(FakeCursor(rows, description), True)
+
+        self.assertEqual(len(features), 1)
+        self.assertTrue(loads(features[0][0]).equals(Point(3, 4)))
+        self.assertEqual(features[0][1:], ({'name': 'b'}, 7))
+
+    def test_read_rows_stopped_early(self):
+        description = [('__id__', ), ('__geometry__', )]
+        rows = [(i, b2a_base64(Point(1, 2).wkb)) for i in range(20000)]
+        rows[2500] = (2500, 0)
+        cursor = FakeCursor(rows, description, delay=.01)
+        threads = active_count()
+
+        try:
+            server.read_features(cursor)
+        except TypeError:
+            # like Connection.__exit__(), look while the traceback is still alive:
+            # the background fetch thread must already be done with the cursor.
+            self.assertEqual(active_count(), threads)
+            self.assertFalse(cursor.fetching)
+        else:
+            self.fail('TypeError not raised')
+
+        self.assertTrue(cursor.rows)
+
+    def test_connections_reused(self):
+        pools, pool_class = dict(server._pools), server.ThreadedConnectionPool
+        server.ThreadedConnectionPool = FakePool
+        dbinfo = {'database': 'test_connections_reused'}
+
+        try:
+            server.set_pool_size(dbinfo, 4)
+
+            with server.Connection(dbinfo):
+                with server.Connection(dbinfo) as db2:
+                    conn2 = db2.connection
+
+            pool, slots = server.get_pool(dbinfo)
+            self.assertEqual(len(pool.opened), 2)
+
+            # connections returned by putconn() stay open, and the next tiles use them.
+            with server.Connection(dbinfo):
+                with server.Connection(dbinfo) as db2:
+                    self.assertTrue(db2.connection is conn2)
+
+            self.assertEqual(len(pool.opened), 2)
+            self.assertFalse([conn for conn in pool.opened if conn.closed])
+
+            # connections closed by the server are discarded.
+            with server.Connection(dbinfo) as db:
+                db.connection.closed = 1
+                closed = db.connection
+
+            for index in range(3):
+                with server.Connection(dbinfo) as db:
+                    self.assertFalse(db.connection is closed)
+        finally:
+            server._pools.clear()
+            server._pools.update(pools)
+            server.ThreadedConnectionPool = pool_class
+
+    def test_query_files(self):
+        dirpath = mkdtemp()
+
+        try:
+            with open(join(dirpath, 'query.pgsql'), 'w') as file:
+                file.write('SELECT 1 AS __geometry__')
+
+            layer = FakeLayer(dirpath + '/')
+            provider = server.Provider(layer, {}, [None, 'query.pgsql', 'SELECT 3'])
+
+            self.assertEqual(provider.get_query(0), None)
+            self.assertEqual(provider.get_query(1), 'SELECT 1 AS __geometry__')
+            self.assertEqual(provider.get_query(2), 'SELECT 3')
+            self.assertEqual(provider.get_query(9), 'SELECT 3')
+
+            with open(join(dirpath, 'query.pgsql'), 'w') as file:
+                file.write('SELECT 2 AS __geometry__')
+
+            # a provider keeps its query, a new one (e.g. after a config reload) reads it again.
+            self.assertEqual(provider.get_query(1), 'SELECT 1 AS __geometry__')
+            self.assertEqual(server.Provider(layer, {}, ['query.pgsql']).get_query(0), 'SELECT 2 AS __geometry__')
+            self.assertEqual(server.load_query('query.pgsql', dirpath + '/'), 'SELECT 2 AS __geometry__')
+        finally:
+            rmtree(dirpath)
+
+    def test_query_columns_per_provider(self):
+        probes = []
+        query_columns = server.query_columns
+        server.query_columns = lambda *args: probes.append(args) or set(['__geometry__'])
+
+        try:
+            layer = FakeLayer('.')
+            provider = server.Provider(layer, {}, ['SELECT 1 AS __geometry__'])
+
+            provider.renderTile(256, 256, None, Coordinate(1, 1, 1))
+            provider.renderTile(256, 256, None, Coordinate(2, 2, 2))
+            self.assertEqual(len(probes), 1)
+
+            # a new provider, e.g. after a config reload, looks at the columns again.
+            response = server.Provider(layer, {}, ['SELECT 1 AS __geometry__']).renderTile(256, 256, None, Coordinate(1, 1, 1))
+            self.assertEqual(len(probes), 2)
+            self.assertEqual(response.columns, set(['__geometry__']))
+        finally:
+            server.query_columns = query_columns
+
+class FakeLayer:
+    ''' Stand-in for a TileStache layer, with just enough for a VecTiles Provider.
+    '''
+    def __init__(self, dirpath):
+        self.config = FakeConfig(dirpath)
+        self.projection = FakeProjection()
+
+    def name(self):
+        return 'fake'
+
+class FakeProjection:
+    def coordinateProj(self, coord):
+        return MMPoint(coord.column * 1000, coord.row * -1000)
+
+class FakeConfig:
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+
+class FakeCursor:
+    ''' Stand-in for a psycopg2 cursor that has already executed a query.
+    '''
+    def __init__(self, rows, description=None, delay=0):
+        self.rows = list(rows)
+        self.description = description
+        self.delay = delay
+        self.fetches = 0
+        self.fetching = False
+
+    def fetchmany(self, size):
+        self.fetching = True
+        sleep(self.delay)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        self.fetches += 1
+        self.fetching = False
+        return rows
+
+class FakePool(ThreadedConnectionPool):
+    ''' Connection pool that opens FakeConnections instead of connecting to Postgres.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.opened = []
+        ThreadedConnectionPool.__init__(self, *args, **kwargs)
+
+    def _connect(self, key=None):
+        conn = FakeConnection()
+        self.opened.append(conn)
+
+        if key is not None:
+            self._used[key] = conn
+            self._rused[id(conn)] = key
+        else:
+            self._pool.append(conn)
+
+        return conn
+
+class FakeConnection:
+    ''' Stand-in for an idle psycopg2 connection.
+    '''
+    def __init__(self):
+        self.closed = 0
+        self.info = self
+
+    transaction_status = TRANSACTION_STATUS_IDLE
+
+    def cursor(self, name=None):
+        cursor = FakeCursor([])
+        cursor.connection = self
+        cursor.close = lambda: None
+        return cursor
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+def varint(*values):
+    ''' Encode unsigned integers as TWKB varints.
+    '''
+    out = bytearray()
+
+    for value in values:
+        while value >= 0x80:
+            out.append(value & 0x7f | 0x80)
+            value >>= 7
+
+        out.append(value)
+
+    return bytes(out)
+
+def signed(*values):
+    ''' Encode signed integers as zigzag TWKB varints.
+    '''
+    return varint(*[(value << 1) ^ -(value < 0) for value in values])
+
+def topojson_dediff(points):
+    ''' Undo TopoJSON delta-encoding of arc points.
+    '''
+    out = [points[0]]
+
+    for (x, y) in points[1:]:
+        out.append([out[-1][0] + x, out[-1][1] + y])
+
+    return out
+
+def get_coords(shape):
+    ''' Get every coordinate of a shapely geometry, for counting.
+    '''
+    if hasattr(shape, 'geoms'):
+        return [coord for part in shape.geoms for coord in get_coords(part)]
+
+    if shape.geom_type == 'Polygon':
+        return list(shape.exterior.coords) + [coord for ring in shape.interiors for coord in ring.coords]
+
+    return list(shape.coords)